@@ -57,6 +57,14 @@ class Config:
     graph_dict_each_cell_fp = os.path.join(base_data_dir, intermediate_dir, "graph_dict_each_cell.obj")
 
     cache_community_detection_dir = os.path.join(base_data_dir, intermediate_dir, "community_detection")
+    # 每个细胞类型的共现次数累加器，用于增量加入或删除一批细胞
+    cache_accumulator_dir = os.path.join(base_data_dir, intermediate_dir, "accumulator")
+    # 解析后的10x 表达矩阵（以及二值化后的矩阵）的二进制缓存，按数据文件的指纹区分；matrix_cache_hash_content 为True 时指纹包括文件内容的哈希
+    cache_matrix_dir = os.path.join(base_data_dir, intermediate_dir, "matrix")
+    # 每个数据集的差异基因（{cell_type: genes}），按数据和Config.deg_threshold_dict 的指纹保存
+    cache_deg_dir = os.path.join(base_data_dir, intermediate_dir, "deg")
+    matrix_cache = True
+    matrix_cache_hash_content = False
 
     cahe_result_edge_style_fp = os.path.join(base_data_dir, intermediate_dir, "result_edge_style.obj")
     cahe_result_edge_style_filted_fp = os.path.join(base_data_dir, intermediate_dir, "result_edge_style_filted.obj")
@@ -110,6 +118,32 @@ class Config:
 
 
 
+    # 计算资源设置
+    #############################################################################################
+    # 关联规则的计算引擎，matrix 为一次性计算所有基因对，block 为按基因分块计算，sparse 为在稀疏矩阵上按块计算，bit 为基于位运算按块计算（比matrix/block 慢，只用于节省内存），count 为只保存整数共现次数，minhash 为通过LSH只计算候选基因对（近似）
+    ar_engine = "matrix"
+    # 分块计算时，单个块允许占用的内存上限（字节），None 表示使用MatrixRuleBlock.default_max_bytes（2GB）。
+    # 只限制每一块的临时矩阵，run_ar 输出的所有基因对的指标矩阵不受该上限限制，见run_ar_pruned
+    ar_max_bytes = None
+    # matrix 和 block 引擎使用的后端，numpy 或 tensorflow，使用numpy时不需要导入TensorFlow
+    ar_backend = "numpy"
+    # 共现矩阵是对称的，为True时分块引擎只计算上三角的块，count 引擎只保存上三角的计数
+    ar_symmetric = True
+    # minhash 引擎（只用于run_ar_pruned）：MinHash签名的长度以及LSH希望找到的基因对的Jaccard相似度
+    minhash_n_hashes = 128
+    minhash_jaccard_threshold = 0.5
+    # run_ar 同时计算的细胞类型数（进程数），为1时依次计算；每个进程中BLAS 的线程数，None 表示cpu核数 / 进程数
+    ar_n_workers = 1
+    ar_threads_per_worker = None
+    # 为True 时CellTypePipe.read_data 按每个细胞类型内的表达占比过滤基因，稀有细胞类型只计算其中表达的基因，否则按全部细胞过滤
+    filter_genes_by_cell_type = False
+    # 每个关联规则对象缓存中间结果（各个指标矩阵、数据框）的内存上限（字节），None 表示不限制，超过上限时按LRU 删除可以重新计算的指标
+    ar_cache_max_bytes = None
+
+    #############################################################################################
+
+
+
 
 
 
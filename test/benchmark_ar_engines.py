@@ -0,0 +1,226 @@
+'''
+关联规则各个计算引擎的基准测试。
+在 基因数 × 细胞数 × 稀疏度 的网格上生成随机的二值稀疏矩阵，对同一份输入分别运行各个引擎，记录运行时间和峰值内存（tracemalloc），
+并与MatrixRule 的结果比较，检查结果是否一致。结果写入json 和 csv 文件，便于在不同版本之间比较。
+
+在项目根目录下运行，例如：
+python -m test.benchmark_ar_engines --genes 200 1000 --cells 2000 20000 --density 0.05 0.2 --out benchmark_result
+'''
+import argparse
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from utils.algorithms.association_rule import AssociationRule
+from utils.algorithms.matrix_association_rule import MatrixRule
+from utils.algorithms.matrix_association_rule_block import MatrixRuleBlock
+from utils.algorithms.sparse_association_rule import SparseMatrixRule
+from utils.algorithms.bit_association_rule import BitMatrixRule
+from utils.algorithms.count_association_rule import CountMatrixRule
+from utils.algorithms.minhash_association_rule import MinHashRule
+from utils.algorithms.incremental_association_rule import CooccurrenceAccumulator
+
+metric_names = ('support', 'confidence', 'lift', 'leverage', 'conviction')
+
+
+# 生成 细胞 × 基因 的二值稀疏矩阵：每个基因的表达比例在 density 的0.5到1.5倍之间，
+# 一部分基因由同一个模块的基因加噪声得到，使数据中存在较强的关联规则
+def make_data(n_genes, n_cells, density, seed=0, n_modules=10, noise=0.2):
+    rng = np.random.default_rng(seed)
+    gene_density = rng.uniform(0.5, 1.5, size=n_genes) * density
+    modules = sp.random(n_cells, n_modules, density=density, random_state=seed, format="csc", dtype=np.float32)
+    modules.data[:] = 1
+    columns = []
+    for gene in range(n_genes):
+        if gene < n_genes // 2:
+            column = modules[:, gene % n_modules].toarray().ravel() != 0
+            flip = rng.random(n_cells) < noise * gene_density[gene]
+            column = column ^ flip
+        else:
+            column = rng.random(n_cells) < gene_density[gene]
+        columns.append(sp.csc_matrix(column.astype(np.float32)[:, None]))
+    data = sp.hstack(columns, format="csr")
+    genes_info = pd.Index([f"gene{i}" for i in range(n_genes)])
+    cells_info = pd.Index([f"cell{i}" for i in range(n_cells)])
+    return data, genes_info, cells_info
+
+
+# 运行func 并记录运行时间（秒）以及运行期间新分配内存的峰值（字节）
+def profile(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+# 两组指标矩阵之间的最大误差（忽略两者都为inf 或nan 的位置）
+def max_error(reference, metrics):
+    error = 0.0
+    for key in metric_names:
+        expected = np.asarray(reference[key], dtype=np.float64)
+        actual = np.asarray(metrics[key], dtype=np.float64)
+        both_finite = np.isfinite(expected) & np.isfinite(actual)
+        if not np.array_equal(np.isfinite(expected), np.isfinite(actual)):
+            return np.inf
+        if both_finite.any():
+            scale = np.maximum(1.0, np.abs(expected[both_finite]))
+            error = max(error, float(np.max(np.abs(actual[both_finite] - expected[both_finite]) / scale)))
+    return error
+
+
+def dense_genes_by_cells(data):
+    return np.ascontiguousarray(data.T.toarray(), dtype=np.float32)
+
+
+# 所有参与测试的引擎，每个引擎返回全部指标矩阵（AssociationRule 只计算抽样的基因对，MinHashRule 返回召回率）
+def engines(max_bytes):
+    def matrix(data, genes_info, cells_info):
+        return MatrixRule(dense_genes_by_cells(data), genes_info, cells_info).all_metrics_to_python
+
+    def block(data, genes_info, cells_info):
+        return MatrixRuleBlock(dense_genes_by_cells(data), genes_info, cells_info,
+                               max_bytes=max_bytes).all_metrics_to_python
+
+    def block_symmetric(data, genes_info, cells_info):
+        return MatrixRuleBlock(dense_genes_by_cells(data), genes_info, cells_info, max_bytes=max_bytes,
+                               symmetric=True).all_metrics_to_python
+
+    def sparse(data, genes_info, cells_info):
+        return SparseMatrixRule(data, genes_info, cells_info, max_bytes=max_bytes,
+                                symmetric=True).all_metrics_to_python
+
+    def bit(data, genes_info, cells_info):
+        return BitMatrixRule(data, genes_info, cells_info, max_bytes=max_bytes, symmetric=True).all_metrics_to_python
+
+    def count(data, genes_info, cells_info):
+        return CountMatrixRule.from_sparse(data, genes_info, cells_info, max_bytes=max_bytes,
+                                           symmetric=True).all_metrics_to_python
+
+    def accumulator(data, genes_info, cells_info):
+        accumulator_obj = CooccurrenceAccumulator(genes_info, max_bytes=max_bytes)
+        accumulator_obj.add_batch(0, data, genes_info)
+        return accumulator_obj.to_rule().all_metrics_to_python
+
+    return {
+        "matrix": matrix,
+        "block": block,
+        "block_symmetric": block_symmetric,
+        "sparse": sparse,
+        "bit": bit,
+        "count": count,
+        "accumulator": accumulator,
+    }
+
+
+# AssociationRule 逐对计算，只抽取n_pairs 个基因对，与MatrixRule 的对应位置比较
+def run_association_rule(data, genes_info, cells_info, reference, n_pairs, seed):
+    rng = np.random.default_rng(seed)
+    n_genes = len(genes_info)
+    i = rng.integers(0, n_genes, size=n_pairs)
+    j = rng.integers(0, n_genes, size=n_pairs)
+    ar_obj = AssociationRule(dense_genes_by_cells(data), genes_info, cells_info)
+    batch, seconds, peak = profile(lambda: ar_obj.all_metrics_batch((i, j)))
+    # AssociationRule 中 i -> j 的值对应矩阵中第j行第i列
+    expected = {
+        "support": reference["support"][j, i],
+        "confidence": reference["confidence"][j, i],
+        "lift": reference["lift"][j, i],
+        "leverage": reference["leverage"][j, i],
+        "conviction": reference["conviction"][j, i],
+    }
+    actual = {
+        "support": batch["support_ij"],
+        "confidence": batch["confidence"],
+        "lift": batch["lift_ij"],
+        "leverage": batch["leverage_ij"],
+        "conviction": batch["conviction_ij"],
+    }
+    return seconds, peak, max_error(expected, actual)
+
+
+def run_case(n_genes, n_cells, density, args):
+    data, genes_info, cells_info = make_data(n_genes, n_cells, density, seed=args.seed)
+    case = {"n_genes": n_genes, "n_cells": n_cells, "density": density, "nnz": int(data.nnz)}
+    rows = []
+    engine_funcs = engines(args.max_bytes)
+    # 所有引擎都与MatrixRule 的结果比较，即使 --engines 中不包含matrix
+    reference = engine_funcs["matrix"](data, genes_info, cells_info)
+    for name, func in engine_funcs.items():
+        if args.engines and name not in args.engines:
+            continue
+        timings = []
+        for _ in range(args.repeat):
+            metrics, seconds, peak = profile(lambda: func(data, genes_info, cells_info))
+            timings.append(seconds)
+        error = max_error(reference, metrics)
+        rows.append({**case, "engine": name, "seconds": min(timings), "peak_bytes": peak,
+                     "max_error": error, "agree": bool(error <= args.tolerance)})
+        del metrics
+    if not args.engines or "association" in args.engines:
+        seconds, peak, error = run_association_rule(data, genes_info, cells_info, reference, args.n_pairs, args.seed)
+        rows.append({**case, "engine": "association", "seconds": seconds, "peak_bytes": peak,
+                     "max_error": error, "agree": bool(error <= args.tolerance), "n_pairs": args.n_pairs})
+    if not args.engines or "minhash" in args.engines:
+        minhash_obj = MinHashRule(data, genes_info, cells_info, jaccard_threshold=args.jaccard_threshold,
+                                  max_bytes=args.max_bytes)
+        recall, seconds, peak = profile(lambda: minhash_obj.recall(args.threshold_dict))
+        rows.append({**case, "engine": "minhash", "seconds": seconds, "peak_bytes": peak,
+                     "max_error": 0.0, "agree": True, **recall})
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="benchmark association rule engines")
+    parser.add_argument("--genes", type=int, nargs="+", default=[200, 1000])
+    parser.add_argument("--cells", type=int, nargs="+", default=[2000, 20000])
+    parser.add_argument("--density", type=float, nargs="+", default=[0.05, 0.2])
+    parser.add_argument("--engines", nargs="*", default=None,
+                        help="matrix, block, block_symmetric, sparse, bit, count, accumulator, association, minhash")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--max-bytes", dest="max_bytes", type=int, default=256 * 1024 ** 2)
+    parser.add_argument("--n-pairs", dest="n_pairs", type=int, default=10000)
+    parser.add_argument("--jaccard-threshold", dest="jaccard_threshold", type=float, default=0.5)
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark_result")
+    args = parser.parse_args()
+    args.threshold_dict = {"support": [0.01, None], "confidence": [0.5, None]}
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    rows = []
+    for n_genes in args.genes:
+        for n_cells in args.cells:
+            for density in args.density:
+                case_rows = run_case(n_genes, n_cells, density, args)
+                for row in case_rows:
+                    print(f"{row['engine']:>16} genes={n_genes} cells={n_cells} density={density}: "
+                          f"{row['seconds']:.3f}s, peak {row['peak_bytes'] / 1024 ** 2:.1f}MB, agree={row['agree']}")
+                rows.extend(case_rows)
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "args": {key: value for key, value in vars(args).items()},
+        "results": rows,
+    }
+    with open(os.path.join(args.out, "benchmark.json"), "w") as f:
+        json.dump(report, f, indent=2, default=float)
+    pd.DataFrame(rows).to_csv(os.path.join(args.out, "benchmark.csv"), index=False)
+    print("finish writing benchmark result to", args.out)
+    if not all(row["agree"] for row in rows):
+        raise SystemExit("results of some engines do not agree with MatrixRule")
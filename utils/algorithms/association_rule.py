@@ -1,9 +1,10 @@
 '''
-基于TensorFlow框架，实现一个计算关联规则的算法
+基于矩阵运算（默认使用NumPy，也可以使用TensorFlow），实现一个计算关联规则的算法
 '''
 
-# 导入TensorFlow
-import tensorflow as tf
+import numpy as np
+from ..util_class.utilclass import lazyproperty, release_cache
+from .backend import get_backend
 
 
 # # import 10x single-cell RNA-seq data
@@ -19,11 +20,64 @@ import tensorflow as tf
 # data = tf.math.divide_no_nan(tf.math.reduce_sum(data, axis=1), 1000)
 
 
+# backend 为计算所用的后端，可以为 numpy 或 tensorflow，默认为numpy，见backend.py
+# cache_max_bytes 为cachedproperty 缓存的中间结果的内存上限，None 表示不限制，超过上限时按LRU 删除可以重新计算的指标
 class AbstractAssociationRule:
-    def __init__(self, data, genes_info, cells_info):
+    cache_max_bytes = None
+
+    def __init__(self, data, genes_info, cells_info, backend=None):
         self.data = data
         self.genes_info = genes_info
         self.cells_info = cells_info
+        self.backend = get_backend(backend)
+
+    # 释放缓存的中间结果（names 为属性名，为空时全部释放），返回释放的字节数，之后访问时会重新计算
+    def release(self, *names):
+        return release_cache(self, *names)
+
+
+# 根据一批基因对的支持度，以及前件、后件基因的支持度，向量化地计算所有指标，公式与all_metrics 一致
+def metrics_from_support_batch(support_ij, support_i, support_j):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confidence = support_ij / support_i
+        lift = confidence / support_j
+        leverage = support_ij - support_i * support_j
+        conviction = (1 - support_j) / (1 - confidence)
+    return {
+        'support_ij': support_ij,
+        'support_i': support_i,
+        'support_j': support_j,
+        'confidence': confidence,
+        'lift_ij': lift,
+        'leverage_ij': leverage,
+        'conviction_ij': conviction
+    }
+
+
+# all_metrics_batch 每一批的基因对数：每个基因对需要提取两个长度为n_cells 的float32 向量，两者合计不超过max_bytes，
+# max_bytes 为None 时使用MatrixRuleBlock.default_max_bytes
+def pair_batch_size(n_cells, max_bytes=None):
+    if max_bytes is None:
+        # matrix_association_rule_block 依赖该模块，这里在使用时才导入
+        from .matrix_association_rule_block import MatrixRuleBlock
+        max_bytes = MatrixRuleBlock.default_max_bytes
+    return int(max(1, max_bytes // max(1, 2 * n_cells * np.dtype(np.float32).itemsize)))
+
+
+# pairs 为 shape=(k, 2) 的基因行号（列号）数组（或由 (i, j) 组成的列表、元组），或者由两个一维numpy数组组成的元组 (i, j)，
+# 返回前件和后件的下标数组。只有两个元素都是一维numpy数组时才按 (i, j) 解释，例如 ((0, 1), (2, 3)) 表示两个基因对 0->1 和 2->3
+def split_pairs(pairs):
+    if isinstance(pairs, tuple) and len(pairs) == 2 and all(isinstance(x, np.ndarray) and x.ndim == 1 for x in pairs):
+        i, j = pairs
+        if len(i) != len(j):
+            raise ValueError("i and j should have the same length")
+    else:
+        pairs = np.asarray(pairs, dtype=np.int64)
+        if pairs.size > 0 and (pairs.ndim != 2 or pairs.shape[1] != 2):
+            raise ValueError("pairs should have shape (k, 2), or be a tuple of two 1-D arrays (i, j)")
+        pairs = pairs.reshape(-1, 2)
+        i, j = pairs[:, 0], pairs[:, 1]
+    return np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
 
 
 # 定义一个计算每一个关联规则算法的类
@@ -41,11 +95,11 @@ class AssociationRule(AbstractAssociationRule):
         # 获取self.data 的列数
         C = self.data.shape[1]
         # 计算第i行的元素个数
-        count = tf.math.count_nonzero(self.data[i, :])
+        count = self.backend.count_nonzero(self.data[i, :])
         # 计算第i列的元素个数占所有元素个数的比例
         support = count / C
         #将support 转换为float32类型
-        support = tf.cast(support, tf.float32)
+        support = self.backend.cast(support, np.float32)
         return support
 
     # 多个基因的支持度
@@ -56,14 +110,14 @@ class AssociationRule(AbstractAssociationRule):
         # 提取self.data 的第i行和第j行
         row_i = self.data[i, :]
         # 将row_i 转置为 1行 n列的张量
-        row_i = tf.expand_dims(row_i, axis=0)
+        row_i = self.backend.expand_dims(row_i, axis=0)
 
         row_j = self.data[j, :]
         # 将row_j 转置为 n行 1列的张量
-        row_j_transpose = tf.expand_dims(row_j, axis=1)
+        row_j_transpose = self.backend.expand_dims(row_j, axis=1)
 
         # 计算两个矩阵的矩阵乘积，即为 i 和 j 的支持度
-        support_ij = tf.matmul(row_i, row_j_transpose) / C
+        support_ij = self.backend.matmul(row_i, row_j_transpose) / C
         return support_ij
 
     # 计算基因i 和基因j的置信度
@@ -139,9 +193,35 @@ class AssociationRule(AbstractAssociationRule):
     #将all_metrics里面所有的Tensor的结果转换为python的数据类型
     def all_metrics_to_python(self, i, j):
         metrics = self.all_metrics(i, j)
-        metrics = {k: v.numpy() for k, v in metrics.items()}
+        metrics = {k: self.backend.to_numpy(v) for k, v in metrics.items()}
         return metrics
 
+    # 所有基因的支持度，只计算一次，供all_metrics_batch 使用
+    @lazyproperty
+    def support_single_all(self):
+        C = self.data.shape[1]
+        count = self.backend.count_nonzero(self.data, axis=1)
+        support = self.backend.cast(count / C, np.float32)
+        return self.backend.to_numpy(support)
+
+    # 一次计算多个基因对的所有指标，pairs 为 shape=(k, 2) 的行号数组，或由两个一维numpy数组组成的元组 (i, j)（见split_pairs），
+    # 基因对的交集按batch_size 分批提取行向量，通过multiply_sum 直接求和而不生成乘积矩阵，返回的结果为一个字典，每个值为长度为k的数组。
+    # batch_size 为None 时由max_bytes 确定（见pair_batch_size）
+    def all_metrics_batch(self, pairs, batch_size=None, max_bytes=None):
+        i, j = split_pairs(pairs)
+        C = self.data.shape[1]
+        if batch_size is None:
+            batch_size = pair_batch_size(C, max_bytes)
+        support = self.support_single_all
+        support_ij = np.empty(len(i), dtype=np.float32)
+        for start in range(0, len(i), batch_size):
+            stop = min(start + batch_size, len(i))
+            rows_i = self.backend.gather(self.data, i[start:stop], axis=0)
+            rows_j = self.backend.gather(self.data, j[start:stop], axis=0)
+            count = self.backend.multiply_sum(rows_i, rows_j, axis=1)
+            support_ij[start:stop] = self.backend.to_numpy(count / C)
+        return metrics_from_support_batch(support_ij, support[i], support[j])
+
 
 
 class AssociationRuleTrans(AbstractAssociationRule):
@@ -157,7 +237,7 @@ class AssociationRuleTrans(AbstractAssociationRule):
         # 获取self.data 的列数
         C = self.data.shape[0]
         # 计算第i行的元素个数
-        count = tf.math.count_nonzero(self.data[:, i])
+        count = self.backend.count_nonzero(self.data[:, i])
         # 计算第i列的元素个数占所有元素个数的比例
         support = count / C
         return support
@@ -172,7 +252,7 @@ class AssociationRuleTrans(AbstractAssociationRule):
         col_j = self.data[:, j]
         # col_i 为 n行 1列的张量，col_j 为 n行 1列的张量， col
         # 计算两个矩阵的矩阵乘积，即为 i 和 j 的支持度
-        support_ij = tf.matmul(col_i, col_j, transpose_a=True) / C
+        support_ij = self.backend.matmul(col_i, col_j, transpose_a=True) / C
         return support_ij
 
     # 计算基因i 和基因j的置信度
@@ -245,3 +325,27 @@ class AssociationRuleTrans(AbstractAssociationRule):
             'leverage_ij': leverage,
             'conviction_ij': conviction
         }
+
+    # 所有基因的支持度，只计算一次，供all_metrics_batch 使用
+    @lazyproperty
+    def support_single_all(self):
+        C = self.data.shape[0]
+        count = self.backend.count_nonzero(self.data, axis=0)
+        support = self.backend.cast(count / C, np.float32)
+        return self.backend.to_numpy(support)
+
+    # 与AssociationRule.all_metrics_batch 相同，这里的基因为列
+    def all_metrics_batch(self, pairs, batch_size=None, max_bytes=None):
+        i, j = split_pairs(pairs)
+        C = self.data.shape[0]
+        if batch_size is None:
+            batch_size = pair_batch_size(C, max_bytes)
+        support = self.support_single_all
+        support_ij = np.empty(len(i), dtype=np.float32)
+        for start in range(0, len(i), batch_size):
+            stop = min(start + batch_size, len(i))
+            cols_i = self.backend.gather(self.data, i[start:stop], axis=1)
+            cols_j = self.backend.gather(self.data, j[start:stop], axis=1)
+            count = self.backend.multiply_sum(cols_i, cols_j, axis=0)
+            support_ij[start:stop] = self.backend.to_numpy(count / C)
+        return metrics_from_support_batch(support_ij, support[i], support[j])
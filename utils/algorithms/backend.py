@@ -0,0 +1,150 @@
+'''
+关联规则计算所使用的后端。MatrixRule 和 AssociationRule 中用到的运算（matmul, reduce_sum, divide, count_nonzero 等）都是普通的线性代数运算，
+默认使用NumPy后端，不需要导入TensorFlow，这样可以大幅减少进程的启动时间和内存占用；需要时可以通过 backend="tensorflow" 使用TensorFlow后端，
+此时TensorFlow只在第一次创建后端时导入。
+'''
+import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import blas
+
+
+class NumpyBackend:
+    name = "numpy"
+
+    # 将输入转换为该后端使用的float32矩阵，稀疏矩阵会被转换为稠密矩阵
+    def from_numpy(self, data):
+        if sp.issparse(data):
+            data = data.toarray()
+        return np.asarray(data, dtype=np.float32)
+
+    def to_numpy(self, data):
+        return np.asarray(data)
+
+    def matmul(self, a, b, transpose_a=False, transpose_b=False):
+        a = np.asarray(a)
+        b = np.asarray(b)
+        if transpose_a:
+            a = a.T
+        if transpose_b:
+            b = b.T
+        return np.matmul(a, b)
+
+    # 计算 data @ data.T。结果为对称矩阵，float32/float64 时使用BLAS的syrk只计算上三角，计算量减半，再按块将上三角复制到下三角。
+    # 注意这里只减少计算量，返回的仍是完整的 n × n 矩阵，内存并没有减半（MatrixRule 的各个指标需要完整的矩阵）；
+    # 需要只保存上三角时使用 CountMatrixRule(symmetric=True)，其共现次数按压缩的上三角保存
+    def gram(self, data, block_rows=1024):
+        data = np.asarray(data)
+        if data.dtype == np.float32:
+            syrk = blas.ssyrk
+        elif data.dtype == np.float64:
+            syrk = blas.dsyrk
+        else:
+            return np.matmul(data, data.T)
+        # data.T 为Fortran顺序的视图，使用trans=1 计算 (data.T).T @ data.T，避免复制输入矩阵
+        gram_m = syrk(1.0, data.T, trans=1)
+        n = gram_m.shape[0]
+        for start in range(0, n, block_rows):
+            stop = min(start + block_rows, n)
+            gram_m[stop:, start:stop] = gram_m[start:stop, stop:].T
+            block = gram_m[start:stop, start:stop]
+            gram_m[start:stop, start:stop] = np.triu(block) + np.triu(block, 1).T
+        # 对称矩阵的转置与自身相等，gram_m.T 是按行存储的视图，不需要复制
+        return gram_m.T
+
+    def reduce_sum(self, data, axis=None):
+        data = np.asarray(data)
+        return np.sum(data, axis=axis, dtype=data.dtype)
+
+    def divide(self, a, b):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.divide(a, b)
+
+    def count_nonzero(self, data, axis=None):
+        return np.count_nonzero(data, axis=axis)
+
+    # a 和 b 对应元素的乘积沿axis 求和，不生成乘积矩阵
+    def multiply_sum(self, a, b, axis):
+        subscripts = 'ij,ij->i' if axis == 1 else 'ij,ij->j'
+        return np.einsum(subscripts, a, b)
+
+    def expand_dims(self, data, axis):
+        return np.expand_dims(data, axis=axis)
+
+    def transpose(self, data):
+        return np.transpose(data)
+
+    def gather(self, data, indices, axis=0):
+        return np.take(data, indices, axis=axis)
+
+    def cast(self, data, dtype):
+        return np.asarray(data).astype(dtype)
+
+
+class TensorflowBackend:
+    name = "tensorflow"
+
+    def __init__(self):
+        import tensorflow as tf
+        self.tf = tf
+
+    def from_numpy(self, data):
+        if sp.issparse(data):
+            data = data.toarray()
+        return self.tf.convert_to_tensor(np.asarray(data, dtype=np.float32))
+
+    def to_numpy(self, data):
+        if hasattr(data, "numpy"):
+            return data.numpy()
+        return np.asarray(data)
+
+    def matmul(self, a, b, transpose_a=False, transpose_b=False):
+        return self.tf.matmul(a, b, transpose_a=transpose_a, transpose_b=transpose_b)
+
+    def gram(self, data):
+        return self.tf.matmul(data, data, transpose_b=True)
+
+    def reduce_sum(self, data, axis=None):
+        return self.tf.reduce_sum(data, axis=axis)
+
+    def divide(self, a, b):
+        return self.tf.divide(a, b)
+
+    def count_nonzero(self, data, axis=None):
+        return self.tf.math.count_nonzero(data, axis=axis)
+
+    def multiply_sum(self, a, b, axis):
+        subscripts = 'ij,ij->i' if axis == 1 else 'ij,ij->j'
+        return self.tf.einsum(subscripts, a, b)
+
+    def expand_dims(self, data, axis):
+        return self.tf.expand_dims(data, axis=axis)
+
+    def transpose(self, data):
+        return self.tf.transpose(data)
+
+    def gather(self, data, indices, axis=0):
+        return self.tf.gather(data, indices, axis=axis)
+
+    def cast(self, data, dtype):
+        return self.tf.cast(data, dtype)
+
+
+backends = {
+    "numpy": NumpyBackend,
+    "tensorflow": TensorflowBackend,
+}
+default_backend = "numpy"
+_instances = {}
+
+
+# backend 可以为后端的名字（numpy 或 tensorflow），None（使用default_backend），或者一个已经创建好的后端对象
+def get_backend(backend=None):
+    if backend is None:
+        backend = default_backend
+    if not isinstance(backend, str):
+        return backend
+    if backend not in backends:
+        raise ValueError("backend should be one of " + ", ".join(backends))
+    if backend not in _instances:
+        _instances[backend] = backends[backend]()
+    return _instances[backend]
@@ -0,0 +1,147 @@
+from .matrix_association_rule_block import MatrixRuleBlock
+from .sparse_association_rule import SparseMatrixRule
+from ..util_class.utilclass import cachedproperty
+import numpy as np
+
+
+'''
+基于整数计数的关联规则。所有指标都只依赖于 (count_ij, count_i, count_j, N)，因此这里只保存整数形式的基因对共现次数，
+细胞数小于65536时使用uint16，否则使用int32，比保存五个float32的指标矩阵节省约5倍以上的内存，同时支持度不存在浮点误差。
+指标在需要时才根据切片或阈值计算。
+'''
+
+
+class CountMatrixRule(MatrixRuleBlock):
+    '''
+    data 为 n_gene × n_gene 的整数共现矩阵，第i行第j列为基因i和基因j同时表达的细胞数，对角线为每个基因表达的细胞数。
+    共现矩阵是对称的，因此data 也可以是按行压缩的上三角（包括对角线）一维数组，长度为 n_gene * (n_gene + 1) / 2，
+    此时内存减半，并以symmetric 模式计算指标。
+    n_cells 为细胞数，如果为None 则使用 len(cells_info)。
+    继承自MatrixRuleBlock，因此 iter_blocks, filter_rules, all_metrics_to_dataframe 等方法都按块从计数中计算指标。
+    '''
+
+    def __init__(self, data, genes_info, cells_info, n_cells=None, max_bytes=None, block_size=None):
+        if n_cells is None:
+            n_cells = len(cells_info)
+        symmetric = np.ndim(data) == 1
+        super().__init__(data, genes_info, cells_info, max_bytes=max_bytes, block_size=block_size, symmetric=symmetric)
+        self._n_cells = int(n_cells)
+        if symmetric:
+            self._n_genes = int((np.sqrt(8 * len(data) + 1) - 1) // 2)
+        else:
+            self._n_genes = data.shape[0]
+
+    @property
+    def n_genes(self):
+        return self._n_genes
+
+    @property
+    def n_cells(self):
+        return self._n_cells
+
+    # 计数可能的最大值为细胞数，据此选择最小的整数类型
+    @staticmethod
+    def count_dtype(n_cells):
+        if n_cells < np.iinfo(np.uint16).max:
+            return np.uint16
+        return np.int32
+
+    # 按行压缩的上三角中，第i行（第i列到最后一列）的起始位置
+    @staticmethod
+    def triangle_offsets(n_genes):
+        index = np.arange(n_genes, dtype=np.int64)
+        return index * n_genes - index * (index - 1) // 2
+
+    # 从任意一个分块计算的引擎（MatrixRuleBlock, SparseMatrixRule, BitMatrixRule）中按块取出共现次数，
+    # symmetric 为True时只计算并保存上三角
+    @classmethod
+    def from_rule(cls, rule, symmetric=False):
+        dtype = cls.count_dtype(rule.n_cells)
+        n_genes = rule.n_genes
+        if symmetric:
+            data = np.empty(n_genes * (n_genes + 1) // 2, dtype=dtype)
+            offsets = cls.triangle_offsets(n_genes)
+            for start, stop in rule.block_ranges():
+                upper = rule.upper_count_block(start, stop)
+                # 第start到stop行的上三角在压缩数组中是连续的一段，按行优先的顺序与上三角的布尔掩码选出的元素一致
+                mask = np.arange(start, n_genes)[None, :] >= np.arange(start, stop)[:, None]
+                data[offsets[start]:offsets[start] + np.count_nonzero(mask)] = upper[mask]
+        else:
+            data = np.empty((n_genes, n_genes), dtype=dtype)
+            for start, stop in rule.block_ranges():
+                data[start:stop] = rule.pair_count_block(start, stop)
+        return cls(data, rule.genes_info, rule.cells_info, n_cells=rule.n_cells, max_bytes=rule.max_bytes)
+
+    # 从二值化后的 细胞 × 基因 的稀疏矩阵计算
+    @classmethod
+    def from_sparse(cls, data, genes_info, cells_info, max_bytes=None, block_size=None, symmetric=False):
+        rule = SparseMatrixRule(data, genes_info, cells_info, max_bytes=max_bytes, block_size=block_size)
+        return cls.from_rule(rule, symmetric=symmetric)
+
+    @cachedproperty(evictable=False)
+    def offsets(self):
+        return self.triangle_offsets(self.n_genes)
+
+    # 压缩的上三角中第k行第k列的位置减去k，第i列中第k行（k < i）的计数位于 lower_base[k] + i
+    @cachedproperty(evictable=False)
+    def lower_base(self):
+        return self.offsets - np.arange(self.n_genes, dtype=np.int64)
+
+    # 基因row 与第col_start到col_stop个基因的共现次数：第row列以后是压缩数组中连续的一段，之前的部分是第row列的上三角，
+    # 通过一次长度为 row - col_start 的索引取出
+    def count_row(self, row, col_start=0, col_stop=None):
+        col_stop = self.n_genes if col_stop is None else col_stop
+        split = min(max(row, col_start), col_stop)
+        upper_start = max(row, col_start)
+        upper = self.data[self.offsets[row] + upper_start - row:self.offsets[row] + col_stop - row]
+        if split == col_start:
+            return upper
+        lower = self.data[self.lower_base[col_start:split] + row]
+        return np.concatenate([lower, upper])
+
+    # 行基因rows 与列基因cols 之间的共现次数，rows 和 cols 可以为切片或行号数组。
+    # 压缩存储时逐行由上三角取出，除了返回的矩阵之外只需要长度为n_gene 的临时数组
+    def count_slice(self, rows, cols):
+        if not self.symmetric:
+            return self.data[rows][:, cols]
+        index = np.arange(self.n_genes)
+        row_index = index[rows]
+        if isinstance(cols, slice) and cols.step in (None, 1):
+            col_start, col_stop, _ = cols.indices(self.n_genes)
+            col_stop = max(col_start, col_stop)
+            col_index = None
+        else:
+            col_start, col_stop = 0, self.n_genes
+            col_index = index[cols]
+        n_cols = col_stop - col_start if col_index is None else len(col_index)
+        out = np.empty((len(row_index), n_cols), dtype=self.data.dtype)
+        for k, row in enumerate(row_index):
+            counts = self.count_row(row, col_start, col_stop)
+            out[k] = counts if col_index is None else counts[col_index]
+        return out
+
+    @cachedproperty(evictable=False)
+    def count_all(self):
+        if self.symmetric:
+            return self.data[self.offsets].astype(np.float32)
+        return np.diagonal(self.data).astype(np.float32)
+
+    @cachedproperty(evictable=False)
+    def support_all(self):
+        return self.count_all / np.float32(self.n_cells)
+
+    def pair_count_block(self, start, stop, col_start=0):
+        return self.count_slice(slice(start, stop), slice(col_start, None)).astype(np.float32)
+
+    # 计算行基因rows 和列基因cols 之间的所有指标，rows 和 cols 可以为None（全部基因）、切片或行号数组
+    def metrics_slice(self, rows=None, cols=None):
+        rows = slice(None) if rows is None else rows
+        cols = slice(None) if cols is None else cols
+        count_m = self.count_slice(rows, cols).astype(np.float32)
+        support_m = count_m / np.float32(self.n_cells)
+        support = self.support_vector
+        return self.metrics_from_support(support_m, support[rows], support[cols])
+
+    # 只计算一个指标，例如 metric("lift", rows=slice(0, 100))
+    def metric(self, name, rows=None, cols=None):
+        return self.metrics_slice(rows, cols)[name]
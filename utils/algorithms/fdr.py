@@ -0,0 +1,63 @@
+import numpy as np
+
+
+'''
+Benjamini–Hochberg 多重检验校正。一个细胞类型中所有基因对的p值可能多达10^8个，无法与指标矩阵一起保存在内存中再全局排序，
+这里按块依次读入所有检验的（对数）p值，只保存：
+1. 需要输出q值的p值（例如FilterArMetrics.filter_pairs 之后保留下来的规则）在全部检验中的精确排名；
+2. 对数p值的直方图，每个桶中的p值个数以及最大的p值。
+BH的q值为 q(p) = min_{p' >= p} p' * m / R(p')，其中m 为检验总数，R(p') 为不大于p' 的p值个数。
+保留下来的p值和每个桶中最大的p值处的 p' * m / R(p') 都是精确的，q值取这些候选值的后缀最小值，
+因此结果不会小于精确的q值（保守），且与精确值的相对误差不超过一个桶的宽度（默认 1 << 16 个桶时约为1%）。
+'''
+
+
+class StreamingBH:
+    '''
+    query_logp 为需要计算q值的对数p值。依次调用update 传入所有检验的对数p值（包括query_logp 本身对应的检验），再调用qvalues 得到q值。
+    n_bins 为直方图的桶数，log_floor 为直方图的下界，小于该值的对数p值都放在第一个桶中。
+    '''
+
+    def __init__(self, query_logp, n_bins=1 << 16, log_floor=-745.0):
+        self.query_logp = np.asarray(query_logp, dtype=np.float64)
+        self.query = np.unique(self.query_logp)
+        self.n_bins = n_bins
+        self.log_floor = log_floor
+        self.n_tests = 0
+        self.query_counts = np.zeros(len(self.query) + 1, dtype=np.int64)
+        self.bin_counts = np.zeros(n_bins, dtype=np.int64)
+        self.bin_max = np.full(n_bins, -np.inf)
+
+    def bin_index(self, logp):
+        index = np.floor((logp - self.log_floor) / -self.log_floor * self.n_bins)
+        return np.clip(index, 0, self.n_bins - 1).astype(np.int64)
+
+    # 加入一块检验的对数p值
+    def update(self, logp):
+        logp = np.asarray(logp, dtype=np.float64).ravel()
+        self.n_tests += len(logp)
+        # 第k个区间为 (query[k-1], query[k]]，累加之后即为不大于query[k] 的p值个数
+        self.query_counts += np.bincount(np.searchsorted(self.query, logp, side="left"),
+                                         minlength=len(self.query) + 1)
+        bins = self.bin_index(logp)
+        self.bin_counts += np.bincount(bins, minlength=self.n_bins)
+        np.maximum.at(self.bin_max, bins, logp)
+
+    # query_logp 对应的q值，顺序与query_logp 一致
+    def qvalues(self):
+        if self.n_tests == 0:
+            raise ValueError("no p-value has been added")
+        log_m = np.log(self.n_tests)
+        query_rank = np.cumsum(self.query_counts)[:len(self.query)]
+        nonempty = self.bin_counts > 0
+        bin_rank = np.cumsum(self.bin_counts)[nonempty]
+        bin_max = self.bin_max[nonempty]
+        # 候选值 log(p' * m / R(p'))，按p' 排序后求后缀最小值
+        values = np.concatenate([self.query, bin_max])
+        with np.errstate(divide="ignore"):
+            log_q = values + log_m - np.log(np.concatenate([query_rank, bin_rank]).astype(np.float64))
+        order = np.argsort(values, kind="stable")
+        values, log_q = values[order], log_q[order]
+        log_q = np.minimum.accumulate(log_q[::-1])[::-1]
+        position = np.searchsorted(values, self.query_logp, side="left")
+        return np.exp(np.minimum(log_q[position], 0.0))
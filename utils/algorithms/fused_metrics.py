@@ -0,0 +1,87 @@
+import numpy as np
+
+
+'''
+融合的指标计算核。MatrixRule 原来的实现中每个指标都是一个新的 n_gene × n_gene 矩阵，计算过程中还会产生同样大小的临时矩阵
+（支持度的外积、1 - confidence 等），转换为numpy 时又复制一遍，峰值约为 12 个 n_gene × n_gene 的矩阵。
+这里所有的运算都通过 out= 写入预先分配好的矩阵，一次遍历共现支持度就得到所有需要的指标，不产生任何 n_gene × n_gene 的临时矩阵；
+只需要应用阈值时，逐个指标在同一个缓冲区中计算并更新布尔掩码，只对满足阈值的基因对计算全部指标。
+support_row 和 support_col 需要能够与support_m 广播，例如 shape=(k, 1) 和 (1, n)，或者与support_m 形状相同的一维数组。
+'''
+
+metric_names = ('support', 'confidence', 'lift', 'leverage', 'conviction')
+
+
+# 计算单个指标并写入out，公式与MatrixRule 中的一致：confidence = support_m / support_col，lift = confidence / support_row，
+# leverage = support_m - support_row * support_col，conviction = (1 - support_row) / (1 - confidence)
+def metric_into(name, support_m, support_row, support_col, out):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if name == 'support':
+            np.copyto(out, support_m)
+        elif name == 'confidence':
+            np.divide(support_m, support_col, out=out)
+        elif name == 'lift':
+            np.divide(support_m, support_col, out=out)
+            np.divide(out, support_row, out=out)
+        elif name == 'leverage':
+            np.multiply(support_row, support_col, out=out)
+            np.subtract(support_m, out, out=out)
+        elif name == 'conviction':
+            np.divide(support_m, support_col, out=out)
+            np.subtract(np.float32(1), out, out=out)
+            np.divide(np.float32(1) - support_row, out, out=out)
+        else:
+            raise ValueError(f"unknown metric {name}, should be one of {metric_names}")
+    return out
+
+
+# 一次计算names 中的所有指标，out 为 {指标名: 预先分配好的矩阵}，缺少的指标会新分配。
+# out['support'] 可以就是support_m 本身；confidence 已经计算时，lift 和 conviction 直接由它得到
+def fused_metrics(support_m, support_row, support_col, out=None, names=metric_names):
+    out = {} if out is None else out
+    shape = np.broadcast_shapes(np.shape(support_m), np.shape(support_row), np.shape(support_col))
+    for name in names:
+        if name not in out:
+            out[name] = np.empty(shape, dtype=np.float32)
+    if 'support' in names and not np.may_share_memory(out['support'], support_m):
+        np.copyto(out['support'], support_m)
+    if 'confidence' in names:
+        confidence = metric_into('confidence', support_m, support_row, support_col, out['confidence'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if 'lift' in names:
+                np.divide(confidence, support_row, out=out['lift'])
+            if 'conviction' in names:
+                np.subtract(np.float32(1), confidence, out=out['conviction'])
+                np.divide(np.float32(1) - support_row, out['conviction'], out=out['conviction'])
+        rest = ('leverage',)
+    else:
+        rest = ('lift', 'leverage', 'conviction')
+    for name in rest:
+        if name in names:
+            metric_into(name, support_m, support_row, support_col, out[name])
+    return {name: out[name] for name in names}
+
+
+# 根据threshold_dict 计算布尔掩码，阈值的含义与MatrixRuleBlock.threshold_mask 一致：大于下限且小于上限，None 表示不限制。
+# 所有指标共用一个缓冲区，keep 为额外需要保留的位置，为None 且没有阈值时返回None
+def fused_mask(support_m, support_row, support_col, threshold_dict, keep=None):
+    shape = np.broadcast_shapes(np.shape(support_m), np.shape(support_row), np.shape(support_col))
+    mask = None if keep is None else np.array(keep, dtype=bool)
+    buffer = None
+    compare = None
+    for name, threshold in threshold_dict.items():
+        if threshold[0] is None and threshold[1] is None:
+            continue
+        if buffer is None:
+            buffer = np.empty(shape, dtype=np.float32)
+            compare = np.empty(shape, dtype=bool)
+            if mask is None:
+                mask = np.ones(shape, dtype=bool)
+        value = metric_into(name, support_m, support_row, support_col, buffer)
+        if threshold[0] is not None:
+            np.greater(value, threshold[0], out=compare)
+            mask &= compare
+        if threshold[1] is not None:
+            np.less(value, threshold[1], out=compare)
+            mask &= compare
+    return mask
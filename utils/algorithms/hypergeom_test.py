@@ -0,0 +1,92 @@
+from scipy.special import gammaln
+import numpy as np
+
+
+'''
+基因对共现的显著性检验。N 个细胞中基因i在K 个细胞中表达，基因j在n 个细胞中表达，如果两个基因相互独立，
+同时表达的细胞数X 服从超几何分布，单侧p值为 P(X >= count_ij)，与 Fisher 精确检验（alternative="greater"）的结果一致。
+逐个基因对调用 scipy.stats.hypergeom.sf 非常慢，这里对整块基因对同时计算：
+先用gammaln 在对数空间中计算起点的概率，再利用相邻两项概率的比值按向量迭代求尾部概率的和，
+每一轮只对尚未收敛的基因对计算，尾部远离众数的基因对只需要很少的迭代。
+'''
+
+
+def _log_comb(a, b):
+    return gammaln(a + 1) - gammaln(b + 1) - gammaln(a - b + 1)
+
+
+# 超几何分布在k 处的对数概率
+def hypergeom_logpmf(k, N, K, n):
+    return _log_comb(K, k) + _log_comb(N - K, n - k) - _log_comb(N, n)
+
+
+# 从起点开始按比值累加各项，返回 sum(pmf(x)) / pmf(start)。
+# step 为1时向上累加到stop，ratio(x) = pmf(x+1) / pmf(x)；step 为-1时向下累加到stop，ratio(x) = pmf(x-1) / pmf(x)。
+# 起点在众数的外侧，各项单调递减，因此和不会溢出，当新的一项小于和的eps 倍时停止（小于半个机器精度的项不会改变结果）。
+# 每一轮对尚未收敛的基因对同时计算width 项（用cumprod 得到连续的各项），width 逐轮加倍，远离众数的基因对在第一轮就会收敛。
+# 到达支持集的边界时比值恰好为0，cumprod 之后超出边界的项都为0，不需要额外处理
+def _tail_ratio_sum(start, stop, N, K, n, step, eps=np.finfo(np.float64).eps / 2, width=8, max_width=256):
+    total = np.ones(len(start), dtype=np.float64)
+    term = np.ones(len(start), dtype=np.float64)
+    x = start.astype(np.float64)
+    active = np.flatnonzero(x != stop)
+    while len(active) > 0:
+        offsets = step * np.arange(width, dtype=np.float64)
+        xa = x[active, None] + offsets[None, :]
+        Ka, na, Na = K[active, None], n[active, None], N[active, None]
+        if step > 0:
+            ratio = (Ka - xa) * (na - xa) / ((xa + 1) * (Na - Ka - na + xa + 1))
+        else:
+            ratio = xa * (Na - Ka - na + xa) / ((Ka - xa + 1) * (na - xa + 1))
+        terms = np.cumprod(ratio, axis=1)
+        terms *= term[active, None]
+        total[active] += terms.sum(axis=1)
+        term[active] = terms[:, -1]
+        x[active] += step * width
+        keep = ((stop[active] - x[active]) * step > 0) & (term[active] > total[active] * eps)
+        active = active[keep]
+        width = min(width * 2, max_width)
+    return total
+
+
+# 按chunk_size 个基因对一组计算尾部的和，使每一轮的临时矩阵保持在缓存中
+def _tail_sum(start, stop, N, K, n, step, chunk_size=512):
+    total = np.empty(len(start), dtype=np.float64)
+    for begin in range(0, len(start), chunk_size):
+        end = begin + chunk_size
+        total[begin:end] = _tail_ratio_sum(start[begin:end], stop[begin:end], N[begin:end],
+                                           K[begin:end], n[begin:end], step)
+    return total
+
+
+# 单侧检验的对数p值 log P(X >= k)，k, N, K, n 可以是任意形状的数组（或可以广播的标量），返回float64 数组
+def hypergeom_logsf(k, N, K, n):
+    k, N, K, n = np.broadcast_arrays(*(np.asarray(value, dtype=np.float64) for value in (k, N, K, n)))
+    shape = k.shape
+    k, N, K, n = (value.ravel() for value in (k, N, K, n))
+    low = np.maximum(0, n + K - N)
+    high = np.minimum(K, n)
+    mode = np.floor((n + 1) * (K + 1) / (N + 2))
+    logsf = np.zeros(len(k), dtype=np.float64)
+    logsf[k > high] = -np.inf
+
+    # k 在众数右侧：直接从k 向上累加上尾
+    upper = np.flatnonzero((k > mode) & (k > low) & (k <= high))
+    if len(upper) > 0:
+        ku, Nu, Ku, nu = k[upper], N[upper], K[upper], n[upper]
+        total = _tail_sum(ku, high[upper], Nu, Ku, nu, step=1)
+        logsf[upper] = hypergeom_logpmf(ku, Nu, Ku, nu) + np.log(total)
+
+    # k 在众数左侧：p值不小于P(X >= 众数)，先从k-1 向下累加下尾，再用 1 - cdf(k-1) 计算
+    lower = np.flatnonzero((k <= mode) & (k > low) & (k <= high))
+    if len(lower) > 0:
+        kl, Nl, Kl, nl = k[lower] - 1, N[lower], K[lower], n[lower]
+        total = _tail_sum(kl, low[lower], Nl, Kl, nl, step=-1)
+        cdf = np.exp(hypergeom_logpmf(kl, Nl, Kl, nl)) * total
+        logsf[lower] = np.log1p(-np.minimum(cdf, 1.0))
+    return logsf.reshape(shape)
+
+
+# 单侧检验的p值 P(X >= k)
+def hypergeom_sf(k, N, K, n):
+    return np.exp(hypergeom_logsf(k, N, K, n))
@@ -0,0 +1,162 @@
+from .matrix_association_rule_block import MatrixRuleBlock
+from .count_association_rule import CountMatrixRule
+from ..data_process.pickle_unpicle import pickle_python_object, unpickle_data
+from ..util_class.utilclass import lazyproperty
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.linalg import blas
+
+
+'''
+增量计算的共现次数。所有指标都只依赖于 (细胞数N, 每个基因的表达细胞数, 基因对的共现次数)，这三个量对细胞是可加的，
+因此新的一批细胞（例如新的10x样本）只需要计算自身的计数再加到累加器上，不需要重新计算旧的细胞；删除一批细胞时减去其计数即可。
+'''
+
+
+class CooccurrenceAccumulator:
+    '''
+    某一个细胞类型的累加器。genes_info 为累加器使用的基因，在创建时确定，之后每一批数据都按基因名对齐：
+    不在genes_info 中的基因被忽略，批次中缺少的基因视为不表达。
+    基因对的共现次数与CountMatrixRule 一样按行压缩的上三角保存，使用int32 累加（细胞数不超过 2^31 - 1），每个细胞类型占用 2 × n_gene^2 字节。
+    batches 记录已经加入的批次及其细胞数，同一个批次不能重复加入。
+    max_bytes 限制add_cells 中每次稠密化的细胞数：每次取 max_bytes / (4 × n_gene) 个细胞转换为稠密矩阵后用BLAS 的syrk 计算共现次数，
+    为None 时使用MatrixRuleBlock.default_max_bytes。
+    '''
+
+    def __init__(self, genes_info, max_bytes=None):
+        self.genes_info = pd.Index(genes_info)
+        self.max_bytes = max_bytes
+        n_genes = len(self.genes_info)
+        self.n_cells = 0
+        self.count_all = np.zeros(n_genes, dtype=np.int64)
+        self.pair_count = np.zeros(n_genes * (n_genes + 1) // 2, dtype=np.int32)
+        self.batches = {}
+
+    @property
+    def n_genes(self):
+        return len(self.genes_info)
+
+    # 将 细胞 × 基因 的二值化矩阵的列按基因名对齐到genes_info
+    def align(self, data, genes_info):
+        data = sp.csr_matrix(data)
+        data.eliminate_zeros()
+        indexer = self.genes_info.get_indexer(pd.Index(genes_info))
+        data = data.tocoo()
+        keep = indexer[data.col] >= 0
+        ones = np.ones(np.count_nonzero(keep), dtype=np.float32)
+        return sp.csr_matrix((ones, (data.row[keep], indexer[data.col[keep]])), shape=(data.shape[0], self.n_genes))
+
+    @lazyproperty
+    def offsets(self):
+        return CountMatrixRule.triangle_offsets(self.n_genes)
+
+    # 将一块已经对齐到genes_info 的二值化细胞直接累加到计数中，用于按块遍历数据，不记录批次。
+    # 过滤基因之后的共现矩阵接近稠密，这里每次将一段细胞转换为稠密的float32 矩阵，用syrk 只计算上三角，再逐行加到压缩的上三角中
+    def add_cells(self, data):
+        data = sp.csr_matrix(data)
+        n_cells = data.shape[0]
+        if self.n_cells + n_cells > np.iinfo(np.int32).max:
+            raise ValueError("accumulator supports at most 2^31 - 1 cells")
+        self.n_cells += n_cells
+        if n_cells == 0:
+            return
+        self.count_all += np.asarray(data.sum(axis=0, dtype=np.int64)).ravel()
+        max_bytes = self.max_bytes if self.max_bytes is not None else MatrixRuleBlock.default_max_bytes
+        # 每一段的细胞数不超过2^24 时float32 的计数是精确的
+        step = int(max(1, min(1 << 24, max_bytes // max(1, self.n_genes * 4))))
+        for start in range(0, n_cells, step):
+            stop = min(start + step, n_cells)
+            self.add_gram(upper_gram(data[start:stop].toarray()))
+
+    # 将 n_gene × n_gene 的共现次数（只使用上三角）逐行加到压缩的上三角中
+    def add_gram(self, gram_m):
+        offsets = self.offsets
+        for i in range(self.n_genes):
+            row = self.pair_count[offsets[i]:offsets[i] + self.n_genes - i]
+            np.add(row, gram_m[i, i:], out=row, casting="unsafe")
+
+    # 计算一批细胞的 (细胞数, 每个基因的计数, 上三角的共现次数)
+    def batch_counts(self, data, genes_info):
+        batch = CooccurrenceAccumulator(self.genes_info, max_bytes=self.max_bytes)
+        batch.add_cells(self.align(data, genes_info))
+        return batch.n_cells, batch.count_all, batch.pair_count
+
+    # data 为二值化后的 细胞 × 基因 的稀疏矩阵（例如LoadMatrixDataReal.load_data 的结果中的adata.X）
+    def add_batch(self, batch_id, data, genes_info):
+        if batch_id in self.batches:
+            raise ValueError(f"batch {batch_id} has already been added")
+        n_cells, count_all, pair_count = self.batch_counts(data, genes_info)
+        self.n_cells += n_cells
+        self.count_all += count_all
+        self.pair_count += pair_count
+        self.batches[batch_id] = n_cells
+
+    # 累加器不保存细胞，删除时需要提供与加入时相同的数据
+    def remove_batch(self, batch_id, data, genes_info):
+        if batch_id not in self.batches:
+            raise ValueError(f"batch {batch_id} has not been added")
+        n_cells, count_all, pair_count = self.batch_counts(data, genes_info)
+        if n_cells != self.batches[batch_id]:
+            raise ValueError(f"batch {batch_id} has {self.batches[batch_id]} cells, but {n_cells} cells are given")
+        self.n_cells -= n_cells
+        self.count_all -= count_all
+        self.pair_count -= pair_count
+        del self.batches[batch_id]
+
+    # 根据当前的计数生成CountMatrixRule，之后可以使用filter_rules, all_metrics_to_dataframe 等方法
+    def to_rule(self):
+        if self.n_cells == 0:
+            raise ValueError("accumulator is empty")
+        dtype = CountMatrixRule.count_dtype(self.n_cells)
+        return CountMatrixRule(self.pair_count.astype(dtype), self.genes_info, None,
+                               n_cells=self.n_cells, max_bytes=self.max_bytes)
+
+    # 累加器需要被覆盖保存，因此不使用pickle_data（文件存在时不会写入）
+    def save(self, path):
+        pickle_python_object(self, path)
+
+    @staticmethod
+    def load(path):
+        return unpickle_data(path)
+
+
+# 计算稠密的 细胞 × 基因 矩阵dense 的 dense.T @ dense，BLAS 的syrk 只计算下三角，返回其转置（按行存储的上三角有效，下三角未定义）
+def upper_gram(dense):
+    dense = np.ascontiguousarray(dense, dtype=np.float32)
+    # dense.T 为Fortran 顺序的视图，syrk 不需要复制输入
+    return blas.ssyrk(1.0, dense.T, trans=0, lower=1).T
+
+
+# 一次遍历 细胞 × 基因 的二值化CSR矩阵，同时计算所有细胞类型的共现次数。
+# groups 为每个细胞的细胞类型（与split_by_cell_type 的cell_type 一致），每次读取chunk_size 个细胞，并将其中每个细胞累加到所属细胞类型的计数中，
+# 这样所有细胞类型共享同一次遍历，也不需要为每个细胞类型复制一份子矩阵。返回 {cell_type: CooccurrenceAccumulator}
+def accumulate_by_group(data, groups, genes_info, chunk_size=4096, batch_id=0, max_bytes=None):
+    data = sp.csr_matrix(data)
+    data.eliminate_zeros()
+    labels, codes = np.unique(np.asarray(groups), return_inverse=True)
+    if len(codes) != data.shape[0]:
+        raise ValueError("groups should have one entry per cell")
+    labels = labels.tolist()
+    accumulators = {label: CooccurrenceAccumulator(genes_info, max_bytes=max_bytes) for label in labels}
+    for start in range(0, data.shape[0], chunk_size):
+        stop = min(start + chunk_size, data.shape[0])
+        add_chunk_by_group(accumulators, labels, data[start:stop], codes[start:stop])
+    for accumulator in accumulators.values():
+        accumulator.batches[batch_id] = accumulator.n_cells
+    return accumulators
+
+
+# 将一块细胞（已经对齐到累加器的基因）按细胞类型加入对应的累加器，chunk_codes 为每个细胞在labels 中的下标。
+# 细胞已经按细胞类型排序时（见LoadMatrixDataReal.split_by_cell_type），每个细胞类型是连续的一段行，直接切片不需要布尔索引
+def add_chunk_by_group(accumulators, labels, chunk, chunk_codes):
+    chunk_codes = np.asarray(chunk_codes)
+    bounds = np.flatnonzero(np.diff(chunk_codes)) + 1
+    starts = np.concatenate([[0], bounds]).astype(np.int64)
+    if len(chunk_codes) > 0 and len(starts) == len(np.unique(chunk_codes)):
+        stops = np.concatenate([bounds, [len(chunk_codes)]]).astype(np.int64)
+        for start, stop in zip(starts, stops):
+            accumulators[labels[chunk_codes[start]]].add_cells(chunk[start:stop])
+        return
+    for code in np.unique(chunk_codes):
+        accumulators[labels[code]].add_cells(chunk[chunk_codes == code])
@@ -0,0 +1,149 @@
+from .bit_association_rule import BitMatrixRule, pair_and_count, popcount64
+from ..util_class.utilclass import lazyproperty
+from concurrent.futures import ThreadPoolExecutor
+import os
+import numpy as np
+import pandas as pd
+
+
+'''
+挖掘三个基因组成的关联规则，如 (TF, cofactor) -> target。
+按照Apriori的向下闭包性质：一个三元组是频繁的，则其包含的三个基因对都是频繁的，因此候选三元组只从满足支持度的基因对中生成，
+三元组的支持度通过压缩后的位向量按位与并统计1的个数得到，计算按块进行，并通过线程池在多个核上并行。
+'''
+
+
+class ItemsetRule(BitMatrixRule):
+    '''
+    data 为二值化后的 细胞 × 基因 的稀疏矩阵（与BitMatrixRule一致）。
+    min_support 为支持度阈值，与LoadMatrixDataReal.filter_genes 一致，只保留支持度大于min_support 的基因、基因对以及三元组。
+    n_jobs 为并行计数时使用的线程数，默认为cpu的核数。
+    '''
+
+    def __init__(self, data, genes_info, cells_info, min_support=0.1, max_bytes=None, block_size=None, n_jobs=None):
+        super().__init__(data, genes_info, cells_info, max_bytes=max_bytes, block_size=block_size)
+        self.min_support = min_support
+        self.n_jobs = n_jobs if n_jobs is not None else (os.cpu_count() or 1)
+
+    # 计数的阈值，计数大于该值的项集为频繁项集
+    @property
+    def min_count(self):
+        return self.min_support * self.n_cells
+
+    # 支持度大于min_support 的基因的行号
+    @lazyproperty
+    def frequent_genes(self):
+        return np.flatnonzero(self.count_all > self.min_count)
+
+    # 所有频繁基因对 (a, b, count)，其中 a < b，按 (a, b) 排序
+    @lazyproperty
+    def frequent_pairs(self):
+        genes = self.frequent_genes
+        words = self.data[genes]
+        pair_a, pair_b, pair_count = [], [], []
+        for start in range(0, len(genes), self.block_size):
+            stop = min(start + self.block_size, len(genes))
+            # 只计算上三角的部分，每个基因对只计算一次
+            count_m = pair_and_count(words[start:stop], words[start:], self.max_bytes)
+            count_m[np.arange(stop - start)[:, None] >= np.arange(len(genes) - start)[None, :]] = 0
+            rows, cols = np.nonzero(count_m > self.min_count)
+            pair_a.append(genes[rows + start])
+            pair_b.append(genes[cols + start])
+            pair_count.append(count_m[rows, cols].astype(np.int64))
+        if not pair_a:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        return np.concatenate(pair_a), np.concatenate(pair_b), np.concatenate(pair_count)
+
+    # 基因对 (a, b) 的共现次数，a < b，基因对以 a * n_gene + b 为键排序后通过二分查找得到
+    @lazyproperty
+    def _pair_keys(self):
+        pair_a, pair_b, _ = self.frequent_pairs
+        return pair_a * self.n_genes + pair_b
+
+    def pair_count(self, a, b):
+        low, high = np.minimum(a, b), np.maximum(a, b)
+        pair_count = self.frequent_pairs[2]
+        return pair_count[np.searchsorted(self._pair_keys, low * self.n_genes + high)]
+
+    # 依次返回候选三元组 (a, b, c)，a < b < c，且三个基因对都是频繁的，每次处理block_size 个频繁基因对
+    def iter_candidate_triples(self):
+        pair_a, pair_b, _ = self.frequent_pairs
+        genes = self.frequent_genes
+        position = np.full(self.n_genes, -1, dtype=np.int64)
+        position[genes] = np.arange(len(genes))
+        # 频繁基因之间的上三角邻接矩阵
+        adjacency = np.zeros((len(genes), len(genes)), dtype=bool)
+        adjacency[position[pair_a], position[pair_b]] = True
+        for start in range(0, len(pair_a), self.block_size):
+            stop = min(start + self.block_size, len(pair_a))
+            a, b = pair_a[start:stop], pair_b[start:stop]
+            common = adjacency[position[a]] & adjacency[position[b]]
+            rows, cols = np.nonzero(common)
+            yield a[rows], b[rows], genes[cols]
+
+    # 统计一批三元组在多少个细胞中同时表达
+    def triple_count(self, a, b, c):
+        both = self.data[a] & self.data[b]
+        both &= self.data[c]
+        return popcount64(both).sum(axis=1, dtype=np.int64)
+
+    # 将三元组按线程数切分后并行计数，每一份的临时矩阵不超过 max_bytes / n_jobs
+    def parallel_triple_count(self, a, b, c, executor):
+        chunk_size = int(max(1, self.max_bytes // (self.n_jobs * self.n_words * 8 * 2)))
+        chunk_size = min(chunk_size, max(1, -(-len(a) // self.n_jobs)))
+        starts = range(0, len(a), chunk_size)
+        counts = executor.map(lambda start: self.triple_count(a[start:start + chunk_size],
+                                                              b[start:start + chunk_size],
+                                                              c[start:start + chunk_size]), starts)
+        counts = list(counts)
+        if not counts:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(counts)
+
+    # 所有频繁三元组 (a, b, c, count)
+    @lazyproperty
+    def frequent_triples(self):
+        triple_a, triple_b, triple_c, triple_count = [], [], [], []
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            for a, b, c in self.iter_candidate_triples():
+                count = self.parallel_triple_count(a, b, c, executor)
+                keep = count > self.min_count
+                triple_a.append(a[keep])
+                triple_b.append(b[keep])
+                triple_c.append(c[keep])
+                triple_count.append(count[keep])
+        if not triple_a:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty, empty
+        return (np.concatenate(triple_a), np.concatenate(triple_b),
+                np.concatenate(triple_c), np.concatenate(triple_count))
+
+    # 每个频繁三元组生成三条规则：(a, b) -> c, (a, c) -> b, (b, c) -> a，指标的公式与MatrixRule一致，只是前件为基因对
+    @lazyproperty
+    def all_triple_rules_to_dataframe(self):
+        a, b, c, count = self.frequent_triples
+        genes = np.asarray(self.genes_info)
+        n_cells = np.float64(self.n_cells)
+        support_single = self.count_all.astype(np.float64) / n_cells
+        frames = []
+        for first, second, consequent in ((a, b, c), (a, c, b), (b, c, a)):
+            support = count / n_cells
+            support_antecedent = self.pair_count(first, second) / n_cells
+            support_consequent = support_single[consequent]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                confidence = support / support_antecedent
+                lift = confidence / support_consequent
+                leverage = support - support_antecedent * support_consequent
+                conviction = (1 - support_consequent) / (1 - confidence)
+            frames.append(pd.DataFrame({
+                "antecedent_1": genes[first],
+                "antecedent_2": genes[second],
+                "consequent": genes[consequent],
+                "support": support,
+                "confidence": confidence,
+                "lift": lift,
+                "leverage": leverage,
+                "conviction": conviction
+            }))
+        return pd.concat(frames, ignore_index=True)
@@ -1,7 +1,8 @@
 # 从a 引入 Ab
 from .association_rule import AbstractAssociationRule
-import tensorflow as tf
-from ..util_class.utilclass import lazyproperty
+from .fused_metrics import fused_metrics
+from ..util_class.utilclass import cachedproperty
+import numpy as np
 import pandas as pd
 
 
@@ -10,69 +11,73 @@ class MatrixRule(AbstractAssociationRule):
     '''
     该类实现的功能是一次性的将所有可能的基因对，通过矩阵运算，一次性的求出
     这里需要注意的是，该算法需要不断地筛选从而保证计算量降低到可以接受的范围内；
+    所有的中间结果通过cachedproperty 缓存，cache_max_bytes 限制缓存的内存，release() 释放缓存；
+    共现矩阵通过backend.gram 只计算上三角（计算量减半），但support_pair_all 以及各个指标仍然保存为完整的 n_gene × n_gene 矩阵，内存没有减半，
+    只保存上三角的计算方式见MatrixRuleBlock(symmetric=True) 和 CountMatrixRule(symmetric=True)；
     需要注意的时返回的矩阵 i -> j 的值，在矩阵中是第i列，第j行的值，也就是从列到行的值
     '''
 
     # 计算所有基因的支持度
-    @lazyproperty
+    @cachedproperty(evictable=False)
     def support_all(self):
         # 对self.data 每一行求和
-        sum = tf.reduce_sum(self.data, axis=1)
-        support = tf.divide(sum, self.data.shape[1])
+        sum = self.backend.reduce_sum(self.data, axis=1)
+        support = self.backend.divide(sum, self.data.shape[1])
         return support
 
-    # 计算所有基因对的支持度
-    @lazyproperty
+    # 计算所有基因对的支持度，其余指标都由它计算，超过缓存上限时不会被删除
+    @cachedproperty(evictable=False)
     def support_pair_all(self):
-        # self.data 矩阵乘 self.data的转置
-        support_m = tf.matmul(self.data, self.data, transpose_b=True)
+        # self.data 矩阵乘 self.data的转置，结果为对称矩阵，numpy后端只计算上三角
+        support_m = self.backend.gram(self.data)
         #support = self.support_all()
-        support_m = tf.divide(support_m, self.data.shape[1])
+        support_m = self.backend.divide(support_m, self.data.shape[1])
         return support_m
 
 
     # 计算所有基因对的置信度, 这里假设support_m 的第i行基因和第j列的支持度，为j -> i 的支持度, 因为广播机制的原理是右端对齐。
-    @lazyproperty
+    @cachedproperty
     def confidence_pair_all(self):
         # 所有基因的支持度，除以所有基因对的支持度
         support = self.support_all
         support_m = self.support_pair_all
-        confidence = tf.divide(support_m, support)
+        confidence = self.backend.divide(support_m, support)
         return confidence
 
     # 计算所有基因对的提升度
-    @lazyproperty
+    @cachedproperty
     def lift_pair_all(self):
         # 所有基因对的置信度， 除以所有基因的支持度, 注意这里的广播机制，通过首先创建了一个维度为1的张量 shape=(n_gene, 1)，然后通过广播机制，将其扩展到了所有基因对的数量 confidence shape=(n_gene, n_gene)
         support = self.support_all
-        support = tf.expand_dims(support, axis=1)
+        support = self.backend.expand_dims(support, axis=1)
         confidence = self.confidence_pair_all
-        lift = tf.divide(confidence, support)
+        lift = self.backend.divide(confidence, support)
         return lift
 
     # 计算所有基因对的leverage levarage(A→C)=support(A→C)−support(A)×support(C),range: [−1,1]
-    @lazyproperty
+    @cachedproperty
     def leverage_pair_all(self):
         #one = tf.constant(1, dtype=tf.float32)
         support = self.support_all
-        support_A = tf.expand_dims(support, axis=1)
-        support_B = tf.transpose(support_A)
+        support_A = self.backend.expand_dims(support, axis=1)
+        support_B = self.backend.transpose(support_A)
 
         support_m = self.support_pair_all
-        leverage = support_m - tf.matmul(support_A, support_B)
+        # 通过广播得到支持度的外积，不需要额外的矩阵乘法
+        leverage = support_m - support_A * support_B
         return leverage
 
     # 计算所有基因对的conviction conviction(A→C)=(1−support(C))/(1−confidence(A→C)),range: [0,∞]
-    @lazyproperty
+    @cachedproperty
     def conviction_pair_all(self):
-        one = tf.constant(1, dtype=tf.float32)
+        one = 1.0
         support = self.support_all
-        support = tf.expand_dims(support, axis=1)
+        support = self.backend.expand_dims(support, axis=1)
         confidence = self.confidence_pair_all
-        conviction = tf.divide(one - support, one - confidence)
+        conviction = self.backend.divide(one - support, one - confidence)
         return conviction
 
-    @lazyproperty
+    @cachedproperty
     def all_metrics(self):
         return {
             'support': self.support_pair_all,
@@ -82,22 +87,20 @@ class MatrixRule(AbstractAssociationRule):
             'conviction': self.conviction_pair_all
         }
 
-    @lazyproperty
+    # 只由共现支持度矩阵和单基因支持度，通过fused_metrics 把其余指标直接写入预先分配好的矩阵，
+    # 不经过confidence_pair_all 等中间张量
+    @cachedproperty
     def all_metrics_to_python(self):
-        return {
-            'support': self.support_pair_all.numpy(),
-            'confidence': self.confidence_pair_all.numpy(),
-            'lift': self.lift_pair_all.numpy(),
-            'leverage': self.leverage_pair_all.numpy(),
-            'conviction': self.conviction_pair_all.numpy()
-        }
+        support_m = np.asarray(self.backend.to_numpy(self.support_pair_all), dtype=np.float32)
+        support = np.asarray(self.backend.to_numpy(self.support_all), dtype=np.float32)
+        return fused_metrics(support_m, support[:, None], support[None, :], out={'support': support_m})
 
     #将所有的指标转化为dataframe，注意这里的每一个指标都是一个矩阵，思路是将每一个矩阵先转换为dataframe,添加一列作为指标名，然后将dataframe合并
     # 返回的结果为列名和索引名为基因名，因为是多个指标的矩阵，按照行的方式合并，所以行索引存在重复，这样能够根据需要提取对应的值，如，需要提取第i个基因的所有指标值，可以用
     #all_metrics_df.loc[i, :], 这样就能提取第i个基因的所有指标值
 
     
-    @lazyproperty
+    @cachedproperty
     def all_metrics_to_dataframe(self, with_name=True):
         all_metrics = self.all_metrics_to_python
         all_metrics_df = None
@@ -1,5 +1,11 @@
 from .matrix_association_rule import MatrixRule
 from .association_rule import AssociationRule
+from .hypergeom_test import hypergeom_logsf
+from .fdr import StreamingBH
+from .fused_metrics import fused_metrics, fused_mask, metric_into
+from ..util_class.utilclass import cachedproperty
+import numpy as np
+import pandas as pd
 
 
 '''
@@ -9,3 +15,226 @@ from .association_rule import AssociationRule
 
 
 class MatrixRuleBlock(MatrixRule):
+    '''
+    分块计算的MatrixRule。沿基因轴（self.data 的行）将基因切分为若干块，每次只计算 block_size 个基因 × 全部基因 的共现矩阵，
+    然后利用所有块共享的单基因支持度，计算该块内的 support, confidence, lift, leverage, conviction。
+    max_bytes 为单个块计算时允许占用的内存上限（字节），block_size 根据 max_bytes 自动确定；也可以通过 block_size 直接指定块的大小。
+    注意max_bytes 只限制每一块计算时的临时矩阵：all_metrics_to_python 仍然会分配五个完整的 n_gene × n_gene float32 矩阵，
+    all_metrics_to_dataframe 再将它们合并为一个数据框，基因数很多（例如上万）时需要使用filter_rules（run_ar_pruned）直接应用阈值。
+    symmetric 为True时利用共现次数的对称性，每一块只计算上三角部分（第start个基因之后的列），计算量减半，
+    有方向的指标（confidence, lift, conviction）由同一个共现次数分别按两个方向计算。
+    返回结果的方向与MatrixRule一致：i -> j 的值在矩阵中是第i列，第j行的值。
+    '''
+    metric_names = ('support', 'confidence', 'lift', 'leverage', 'conviction')
+    # 计算一个块时同时存在的 block_size × n_gene 的float32矩阵个数：共现矩阵、支持度以及阈值计算所用的缓冲区和掩码，
+    # 指标由fused_metrics 直接写入输出矩阵，不产生中间结果
+    n_buffers = 4
+    # 唯一的默认值，Config.ar_max_bytes 为None 时使用
+    default_max_bytes = 2 * 1024 ** 3
+
+    def __init__(self, data, genes_info, cells_info, max_bytes=None, block_size=None, symmetric=False, backend=None):
+        super().__init__(data, genes_info, cells_info, backend=backend)
+        self.max_bytes = max_bytes if max_bytes is not None else self.default_max_bytes
+        self._block_size = block_size
+        self.symmetric = symmetric
+
+    @property
+    def n_genes(self):
+        return self.data.shape[0]
+
+    @property
+    def n_cells(self):
+        return self.data.shape[1]
+
+    # 根据max_bytes 计算每一块包含的基因数，至少为1，至多为基因总数
+    @cachedproperty(evictable=False)
+    def block_size(self):
+        if self._block_size is not None:
+            return int(max(1, min(self._block_size, self.n_genes)))
+        bytes_per_row = max(1, self.n_genes) * np.dtype(np.float32).itemsize * self.n_buffers
+        return int(max(1, min(self.n_genes, self.max_bytes // bytes_per_row)))
+
+    # 所有基因的支持度，所有块共享
+    @cachedproperty(evictable=False)
+    def support_vector(self):
+        return np.asarray(self.backend.to_numpy(self.support_all), dtype=np.float32)
+
+    # 计算第start到stop个基因与第col_start个之后的所有基因的共现次数，shape=(stop-start, n_gene-col_start)
+    def pair_count_block(self, start, stop, col_start=0):
+        count_m = self.backend.matmul(self.data[start:stop], self.data[col_start:], transpose_b=True)
+        return np.asarray(self.backend.to_numpy(count_m), dtype=np.float32)
+
+    # 上三角的块：第start到stop个基因与第start个之后的所有基因的共现次数
+    def upper_count_block(self, start, stop):
+        return self.pair_count_block(start, stop, col_start=start)
+
+    # 由共现支持度以及行、列基因的支持度计算所有指标，公式与MatrixRule中的一致。
+    # out 为 {指标名: 预先分配好的矩阵}，指标直接写入其中（见fused_metrics），为None 时新分配
+    @staticmethod
+    def metrics_from_support(support_m, support_row, support_col, out=None):
+        support_row = np.expand_dims(support_row, axis=1)
+        support_col = np.expand_dims(support_col, axis=0)
+        return fused_metrics(support_m, support_row, support_col, out=out)
+
+    # 计算第start到stop个基因（行）与所有基因（列）之间的所有指标
+    def metrics_block(self, start, stop):
+        count_m = self.pair_count_block(start, stop)
+        support_m = count_m / np.float32(self.n_cells)
+        support = self.support_vector
+        return self.metrics_from_support(support_m, support[start:stop], support)
+
+    # 由共现支持度以及行、列基因的支持度计算共现的单侧超几何检验p值，检验对两个基因是对称的，因此与规则的方向无关
+    def pvalue_from_support(self, support_m, support_row, support_col):
+        n_cells = np.float64(self.n_cells)
+        count_m = np.rint(np.asarray(support_m, dtype=np.float64) * n_cells)
+        count_row = np.rint(np.asarray(support_row, dtype=np.float64) * n_cells)
+        count_col = np.rint(np.asarray(support_col, dtype=np.float64) * n_cells)
+        return np.exp(hypergeom_logsf(count_m, n_cells, count_row, count_col))
+
+    # 依次返回每一块中所有无序基因对（上三角，不包括对角线）共现的对数p值，每个基因对只检验一次
+    def iter_logpvalue_blocks(self):
+        count = np.rint(self.support_vector.astype(np.float64) * self.n_cells)
+        for start, stop in self.block_ranges():
+            count_m = self.upper_count_block(start, stop)
+            rows, cols = np.nonzero(np.arange(start, stop)[:, None] < np.arange(start, self.n_genes)[None, :])
+            yield hypergeom_logsf(count_m[rows, cols].astype(np.float64), self.n_cells,
+                                  count[rows + start], count[cols + start])
+
+    # 对边列表（FilterArMetrics.filter_pairs 或 filter_rules 的结果）中的规则计算BH校正后的q值，增加一列 q_value。
+    # 多重检验的总数为所有无序基因对的个数，所有基因对的p值按块流式地计算，不会同时保存在内存中
+    def qvalues(self, pairs_df, n_bins=1 << 16):
+        pairs_df = pairs_df.copy()
+        genes = pd.Index(self.genes_info)
+        row_index = genes.get_indexer(pairs_df["antecedent"])
+        col_index = genes.get_indexer(pairs_df["consequent"])
+        if (row_index < 0).any() or (col_index < 0).any():
+            raise ValueError("pairs_df contains genes that are not in genes_info")
+        count = np.rint(self.support_vector.astype(np.float64) * self.n_cells)
+        count_m = np.rint(pairs_df["support"].to_numpy(dtype=np.float64) * self.n_cells)
+        query_logp = hypergeom_logsf(count_m, self.n_cells, count[row_index], count[col_index])
+        bh = StreamingBH(query_logp, n_bins=n_bins)
+        for logp in self.iter_logpvalue_blocks():
+            bh.update(logp)
+        pairs_df["q_value"] = bh.qvalues()
+        return pairs_df
+
+    # 依次返回每一块的起止位置
+    def block_ranges(self):
+        for start in range(0, self.n_genes, self.block_size):
+            yield start, min(start + self.block_size, self.n_genes)
+
+    # 依次返回每一块的结果：(start, stop, {指标名: shape=(stop-start, n_gene) 的矩阵})
+    def iter_blocks(self):
+        for start, stop in self.block_ranges():
+            yield start, stop, self.metrics_block(start, stop)
+
+    # 根据threshold_dict 生成布尔矩阵，阈值的含义与FilterArMetrics.filter_pairs_in_df 一致：大于下限且小于上限，None 表示不限制
+    @staticmethod
+    def threshold_mask(metrics, threshold_dict):
+        mask = None
+        for metric, threshold in threshold_dict.items():
+            value = metrics[metric]
+            if mask is None:
+                mask = np.ones(value.shape, dtype=bool)
+            if threshold[0] is not None:
+                mask &= value > threshold[0]
+            if threshold[1] is not None:
+                mask &= value < threshold[1]
+        return mask
+
+    # 对一块共现支持度应用阈值，row_index 和 col_index 为该块的行、列基因的行号，keep 为额外需要保留的位置。
+    # 阈值逐个指标在同一个缓冲区中计算（见fused_mask），只对满足阈值的基因对计算全部指标；p值只对满足其余阈值的基因对计算
+    def _filter_tile(self, support_m, row_index, col_index, threshold_dict, keep, pvalue=False):
+        support = self.support_vector
+        metric_threshold = {key: value for key, value in threshold_dict.items() if key != "p_value"}
+        mask = fused_mask(support_m, support[row_index][:, None], support[col_index][None, :], metric_threshold, keep)
+        rows, cols = np.nonzero(mask)
+        support_row = support[row_index[rows]]
+        support_col = support[col_index[cols]]
+        metrics = fused_metrics(support_m[rows, cols], support_row, support_col)
+        genes = np.asarray(self.genes_info)
+        frame = {"antecedent": genes[row_index[rows]], "consequent": genes[col_index[cols]]}
+        for key in self.metric_names:
+            frame[key] = metrics[key]
+        frame = pd.DataFrame(frame)
+        if pvalue or "p_value" in threshold_dict:
+            frame["p_value"] = self.pvalue_from_support(metrics["support"], support_row, support_col)
+            if "p_value" in threshold_dict:
+                frame = frame[self.threshold_mask({"p_value": frame["p_value"].values}, {"p_value": threshold_dict["p_value"]})]
+        return frame
+
+    # 在分块计算时直接应用阈值，只保留满足threshold_dict 的基因对，内存占用只与单个块以及保留下来的基因对的数量有关。
+    # 返回的数据框与FilterArMetrics.filter_pairs_in_df 的结果结构一致，列名沿用transform_to_pairs_in_df 的约定：
+    # 矩阵的行基因记为antecedent，列基因记为consequent，基因与自身的组合会被删除。
+    # pvalue 为True 时增加一列共现的超几何检验p值，threshold_dict 中也可以包含 "p_value" 的阈值，例如 {"p_value": [None, 0.05]}
+    def filter_rules(self, threshold_dict=None, pvalue=False):
+        if threshold_dict is None:
+            threshold_dict = {}
+        support = self.support_vector
+        # 基因对的支持度不会超过单个基因的支持度，因此所有行基因的支持度都不满足阈值的块可以直接跳过
+        min_support = threshold_dict.get("support", [None, None])[0]
+        frames = []
+        for start, stop in self.block_ranges():
+            if min_support is not None and not (support[start:stop] > min_support).any():
+                continue
+            row_index = np.arange(start, stop)
+            if self.symmetric:
+                # 上三角的块同时给出 i -> j 和 j -> i 两个方向，只保留严格上三角的位置，避免重复
+                col_index = np.arange(start, self.n_genes)
+                support_m = self.upper_count_block(start, stop) / np.float32(self.n_cells)
+                keep = row_index[:, None] < col_index[None, :]
+                frames.append(self._filter_tile(support_m, row_index, col_index, threshold_dict, keep, pvalue))
+                frames.append(self._filter_tile(support_m.T, col_index, row_index, threshold_dict, keep.T, pvalue))
+            else:
+                col_index = np.arange(self.n_genes)
+                support_m = self.pair_count_block(start, stop) / np.float32(self.n_cells)
+                keep = row_index[:, None] != col_index[None, :]
+                frames.append(self._filter_tile(support_m, row_index, col_index, threshold_dict, keep, pvalue))
+        if not frames:
+            columns = ["antecedent", "consequent", *self.metric_names]
+            if pvalue or "p_value" in threshold_dict:
+                columns.append("p_value")
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    # 由每一块的共现次数填满完整的支持度矩阵，分块计算只在这里进行一次；其余指标都由它逐元素计算，超过缓存上限时不会被删除
+    @cachedproperty(evictable=False)
+    def support_pair_all(self):
+        support_m = np.empty((self.n_genes, self.n_genes), dtype=np.float32)
+        n_cells = np.float32(self.n_cells)
+        if not self.symmetric:
+            for start, stop in self.block_ranges():
+                np.divide(self.pair_count_block(start, stop), n_cells, out=support_m[start:stop])
+        else:
+            # 对称模式下由上三角的块同时填写两个方向
+            for start, stop in self.block_ranges():
+                upper = self.upper_count_block(start, stop)
+                upper /= n_cells
+                support_m[start:stop, start:] = upper
+                support_m[start:, start:stop] = upper.T
+        return self.backend.from_numpy(support_m)
+
+    # 由支持度矩阵按块计算一个指标，写入预先分配好的矩阵，不产生 n_gene × n_gene 的临时矩阵
+    def metric_matrix(self, name):
+        support_m = np.asarray(self.backend.to_numpy(self.support_pair_all), dtype=np.float32)
+        support = self.support_vector
+        out = np.empty((self.n_genes, self.n_genes), dtype=np.float32)
+        for start, stop in self.block_ranges():
+            metric_into(name, support_m[start:stop], support[start:stop, None], support[None, :], out[start:stop])
+        return out
+
+    @cachedproperty
+    def confidence_pair_all(self):
+        return self.backend.from_numpy(self.metric_matrix('confidence'))
+
+    @cachedproperty
+    def lift_pair_all(self):
+        return self.backend.from_numpy(self.metric_matrix('lift'))
+
+    @cachedproperty
+    def leverage_pair_all(self):
+        return self.backend.from_numpy(self.metric_matrix('leverage'))
+
+    @cachedproperty
+    def conviction_pair_all(self):
+        return self.backend.from_numpy(self.metric_matrix('conviction'))
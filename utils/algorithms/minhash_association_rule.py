@@ -0,0 +1,144 @@
+from .sparse_association_rule import SparseMatrixRule
+from ..util_class.utilclass import cachedproperty
+import numpy as np
+import pandas as pd
+
+
+'''
+基于MinHash/LSH 的近似关联规则。基因数很多时（例如subset_by_genes 中network_sel=False），所有基因对的数量为基因数的平方，
+即使分块计算也无法完成。这里先为每个基因表达的细胞集合计算MinHash签名，再通过LSH分段（banding）把签名相似的基因放入同一个桶中，
+同一个桶中的基因对作为候选，只对候选基因对在稀疏矩阵上精确计算共现次数和所有指标。
+两个基因的Jaccard相似度为 s 时，成为候选的概率为 1 - (1 - s^rows)^bands，阈值约为 (1/bands)^(1/rows)。
+'''
+
+
+# 梅森素数 2^31 - 1，哈希函数为 (a * x + b) mod P
+_PRIME = np.int64((1 << 31) - 1)
+
+
+# 根据签名的长度和Jaccard阈值选择 (bands, rows)，在阈值 (1/bands)^(1/rows) 不超过jaccard_threshold 的组合中选择最接近的
+def choose_bands(n_hashes, jaccard_threshold):
+    best = (n_hashes, 1)
+    best_gap = np.inf
+    for rows in range(1, n_hashes + 1):
+        bands = n_hashes // rows
+        threshold = (1.0 / bands) ** (1.0 / rows)
+        if threshold <= jaccard_threshold and jaccard_threshold - threshold < best_gap:
+            best, best_gap = (bands, rows), jaccard_threshold - threshold
+    return best
+
+
+class MinHashRule(SparseMatrixRule):
+    '''
+    data 为二值化后的 细胞 × 基因 的稀疏矩阵（与SparseMatrixRule一致）。
+    n_hashes 为MinHash签名的长度，jaccard_threshold 为希望找到的基因对的Jaccard相似度，据此选择LSH的bands 和 rows。
+    min_confidence 不为None 时，同时希望找到置信度不小于min_confidence 的基因对：置信度为c 的基因对的Jaccard相似度不小于
+    c * r / (1 + r - c * r)，r 为两个基因表达细胞数之比（小比大），这里用所有基因中最小的比值得到Jaccard的下界，并以两者中较小的阈值选择bands。
+    seed 为哈希函数的随机种子。
+    '''
+
+    def __init__(self, data, genes_info, cells_info, n_hashes=128, jaccard_threshold=0.5, min_confidence=None,
+                 max_bytes=None, block_size=None, seed=0):
+        super().__init__(data, genes_info, cells_info, max_bytes=max_bytes, block_size=block_size)
+        self.n_hashes = n_hashes
+        self.jaccard_threshold = jaccard_threshold
+        self.min_confidence = min_confidence
+        self.seed = seed
+
+    # 用于选择bands 的Jaccard阈值
+    @cachedproperty(evictable=False)
+    def effective_threshold(self):
+        threshold = self.jaccard_threshold
+        if self.min_confidence is not None:
+            count = self.count_all[self.count_all > 0]
+            if len(count) > 0:
+                ratio = count.min() / count.max()
+                c = self.min_confidence
+                threshold = min(threshold, c * ratio / (1 + ratio - c * ratio))
+        return threshold
+
+    @cachedproperty(evictable=False)
+    def bands(self):
+        return choose_bands(self.n_hashes, self.effective_threshold)
+
+    # n_hashes × n_gene 的MinHash签名，不表达的基因的签名为P（不会与其他基因相同的桶中出现，见candidate_pairs）
+    @cachedproperty(evictable=False)
+    def signatures(self):
+        rng = np.random.default_rng(self.seed)
+        a = rng.integers(1, _PRIME, size=self.n_hashes, dtype=np.int64)
+        b = rng.integers(0, _PRIME, size=self.n_hashes, dtype=np.int64)
+        data = self.data_csc
+        nonempty = np.flatnonzero(np.diff(data.indptr) > 0)
+        signatures = np.full((self.n_hashes, self.n_genes), _PRIME, dtype=np.int64)
+        cells = np.arange(self.n_cells, dtype=np.int64)
+        for k in range(self.n_hashes):
+            hashed = (a[k] * cells + b[k]) % _PRIME
+            signatures[k, nonempty] = np.minimum.reduceat(hashed[data.indices], data.indptr[nonempty])
+        return signatures
+
+    # LSH得到的所有候选基因对 (a, b)，a < b，去重并排序
+    @cachedproperty(evictable=False)
+    def candidate_pairs(self):
+        bands, rows = self.bands
+        signatures = self.signatures
+        expressed = np.flatnonzero(self.count_all > 0)
+        keys = []
+        for band in range(bands):
+            band_signature = signatures[band * rows:(band + 1) * rows, expressed].T
+            _, labels = np.unique(band_signature, axis=0, return_inverse=True)
+            labels = labels.ravel()
+            order = np.argsort(labels, kind="stable")
+            bounds = np.flatnonzero(np.diff(labels[order])) + 1
+            for bucket in np.split(order, bounds):
+                if len(bucket) < 2:
+                    continue
+                genes = expressed[bucket]
+                first, second = np.triu_indices(len(genes), 1)
+                keys.append(genes[first] * self.n_genes + genes[second])
+        if not keys:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+        keys = np.unique(np.concatenate(keys))
+        return keys // self.n_genes, keys % self.n_genes
+
+    # 只对候选基因对计算指标并应用阈值，返回的数据框与MatrixRuleBlock.filter_rules 的结构一致（两个方向的规则都会给出）
+    def filter_rules(self, threshold_dict=None, pvalue=False):
+        if threshold_dict is None:
+            threshold_dict = {}
+        a, b = self.candidate_pairs
+        count = self.pair_count(a, b)
+        support = self.support_vector
+        genes = np.asarray(self.genes_info)
+        frames = []
+        for rows, cols in ((a, b), (b, a)):
+            metrics = self.pair_metrics(rows, cols, count=count)
+            mask = self.threshold_mask(metrics, {k: v for k, v in threshold_dict.items() if k != "p_value"})
+            keep = np.ones(len(rows), dtype=bool) if mask is None else mask
+            frame = {"antecedent": genes[rows[keep]], "consequent": genes[cols[keep]]}
+            for key in self.metric_names:
+                frame[key] = metrics[key][keep]
+            frame = pd.DataFrame(frame)
+            if pvalue or "p_value" in threshold_dict:
+                frame["p_value"] = self.pvalue_from_support(metrics["support"][keep], support[rows[keep]], support[cols[keep]])
+                if "p_value" in threshold_dict:
+                    frame = frame[self.threshold_mask({"p_value": frame["p_value"].values},
+                                                      {"p_value": threshold_dict["p_value"]})]
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True)
+
+    # 与精确的分块计算结果比较，返回召回率等统计，用于在基准数据上评估bands 的选择
+    def recall(self, threshold_dict=None):
+        approximate = self.filter_rules(threshold_dict)
+        exact = SparseMatrixRule.filter_rules(self, threshold_dict)
+        exact_pairs = set(zip(exact["antecedent"], exact["consequent"]))
+        found = set(zip(approximate["antecedent"], approximate["consequent"]))
+        n_pairs = self.n_genes * (self.n_genes - 1) // 2
+        return {
+            "bands": self.bands[0],
+            "rows": self.bands[1],
+            "n_candidates": len(self.candidate_pairs[0]),
+            "candidate_fraction": len(self.candidate_pairs[0]) / max(1, n_pairs),
+            "n_exact": len(exact_pairs),
+            "n_found": len(exact_pairs & found),
+            "recall": len(exact_pairs & found) / max(1, len(exact_pairs))
+        }
@@ -0,0 +1,44 @@
+from scipy.stats import norm
+import numpy as np
+import pandas as pd
+
+
+'''
+基于细胞抽样的指标估计。在每个细胞类型中随机抽取一部分细胞（分层抽样，见LoadMatrixDataReal.subsample_by_cell_type），
+在样本上计算的支持度和置信度都是比例的估计：支持度为 count_ij / n，置信度为 count_ij / count_j，
+这里用Wilson区间给出置信区间，抽样为不放回抽样，已知细胞类型的总细胞数时对方差做有限总体校正。
+'''
+
+
+# 比例 successes / trials 的Wilson置信区间，population 为总体的大小（不放回抽样时的有限总体校正），level 为置信水平
+def wilson_interval(successes, trials, level=0.95, population=None):
+    successes = np.asarray(successes, dtype=np.float64)
+    trials = np.asarray(trials, dtype=np.float64)
+    z = norm.ppf(0.5 + level / 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = successes / trials
+        z2 = z * z
+        if population is not None:
+            # 有限总体校正，相当于将方差乘以 (N - n) / (N - 1)
+            z2 = z2 * np.clip((population - trials) / np.maximum(population - 1, 1), 0, 1)
+        center = (p + z2 / (2 * trials)) / (1 + z2 / trials)
+        half = np.sqrt(z2) * np.sqrt(p * (1 - p) / trials + z2 / (4 * trials * trials)) / (1 + z2 / trials)
+    return np.clip(center - half, 0, 1), np.clip(center + half, 0, 1)
+
+
+# 为边列表（filter_rules 的结果）增加支持度和置信度的置信区间：support_low, support_high, confidence_low, confidence_high。
+# rule 为在样本上计算的引擎（提供n_cells 和 count_all），n_population 为该细胞类型的总细胞数，None 表示不做有限总体校正
+def add_confidence_intervals(pairs_df, rule, n_population=None, level=0.95):
+    pairs_df = pairs_df.copy()
+    n_cells = rule.n_cells
+    genes = pd.Index(rule.genes_info)
+    consequent = genes.get_indexer(pairs_df["consequent"])
+    count_ij = np.rint(pairs_df["support"].to_numpy(dtype=np.float64) * n_cells)
+    count_j = np.asarray(rule.count_all, dtype=np.float64)[consequent]
+    low, high = wilson_interval(count_ij, n_cells, level=level, population=n_population)
+    pairs_df["support_low"], pairs_df["support_high"] = low, high
+    # 置信度是在consequent 表达的细胞中的比例，对应的总体大小按抽样比例估计
+    population_j = None if n_population is None else count_j * n_population / n_cells
+    low, high = wilson_interval(count_ij, count_j, level=level, population=population_j)
+    pairs_df["confidence_low"], pairs_df["confidence_high"] = low, high
+    return pairs_df
@@ -0,0 +1,101 @@
+from .matrix_association_rule_block import MatrixRuleBlock
+from .association_rule import metrics_from_support_batch
+from ..util_class.utilclass import cachedproperty
+import numpy as np
+import scipy.sparse as sp
+
+
+'''
+基于scipy稀疏矩阵的关联规则算法，直接在二值化后的 细胞 × 基因 的CSR矩阵上计算基因的共现次数，
+整个过程不会生成稠密的 细胞 × 基因 矩阵，只会按块生成 block_size × n_gene 的共现矩阵
+'''
+
+
+class SparseMatrixRule(MatrixRuleBlock):
+    '''
+    data 为二值化后的稀疏矩阵（例如LoadMatrixDataReal.load_data 的结果中的adata.X），每一行代表一个细胞，每一列代表一个基因，
+    注意这里的方向与MatrixRule相反，这样可以直接使用AnnData中的矩阵，而不需要转置。
+    基因对的共现次数通过 X[:, start:stop].T @ X 按块计算（见count_operand 和pair_count_block），指标的计算公式与MatrixRule一致。
+    '''
+
+    def __init__(self, data, genes_info, cells_info, max_bytes=None, block_size=None, symmetric=False):
+        # 只保存一份按列存储的矩阵，并保留二值化矩阵原来的数据类型（例如uint8），不转换为float32
+        data = sp.csc_matrix(data)
+        # 二值化矩阵中低于阈值的元素被保存为显式的0，这里将其删除
+        data.eliminate_zeros()
+        super().__init__(data, genes_info, cells_info, max_bytes=max_bytes, block_size=block_size, symmetric=symmetric)
+
+    @property
+    def n_genes(self):
+        return self.data.shape[1]
+
+    @property
+    def n_cells(self):
+        return self.data.shape[0]
+
+    # self.data 已经按列存储，保留该属性以兼容按列读取基因的代码
+    @property
+    def data_csc(self):
+        return self.data
+
+    # 计算共现次数所用的 基因 × 细胞 的CSR矩阵：与self.data 共享indices 和indptr，只另外保存一份float32 的数据。
+    # scipy 的稀疏矩阵乘法要求两边的数据类型相同，否则每一块都会把整个矩阵转换一遍，因此这里只在开始时转换一次
+    @cachedproperty(evictable=False)
+    def count_operand(self):
+        data = self.data
+        ones = np.ones(data.nnz, dtype=np.float32)
+        return sp.csr_matrix((ones, data.indices, data.indptr), shape=(self.n_genes, self.n_cells), copy=False)
+
+    # 每个基因在多少个细胞中表达
+    @cachedproperty(evictable=False)
+    def count_all(self):
+        return np.diff(self.data.indptr).astype(np.float32)
+
+    @cachedproperty(evictable=False)
+    def support_all(self):
+        return self.count_all / np.float32(self.n_cells)
+
+    # 第start到stop个基因与第col_start个之后的基因的共现次数：count_operand 的行切片直接共享其数组，不会复制矩阵，
+    # 只有该块的基因（转置为CSR）会被复制
+    def pair_count_block(self, start, stop, col_start=0):
+        operand = self.count_operand
+        block = csr_row_slice(operand, start, stop)
+        cols = operand if col_start == 0 else csr_row_slice(operand, col_start, self.n_genes)
+        count_m = cols @ block.T
+        return np.ascontiguousarray(count_m.toarray().T, dtype=np.float32)
+
+    # 精确计算任意基因对 (a, b) 的共现次数，a 和 b 为基因的列号数组，每一批的临时稀疏矩阵不超过max_bytes
+    def pair_count(self, a, b):
+        data = self.data_csc
+        nnz_per_gene = max(1.0, data.nnz / max(1, self.n_genes))
+        batch_size = int(max(1, self.max_bytes // (nnz_per_gene * 3 * 12)))
+        counts = np.empty(len(a), dtype=np.float32)
+        for start in range(0, len(a), batch_size):
+            stop = min(start + batch_size, len(a))
+            both = data[:, a[start:stop]].multiply(data[:, b[start:stop]])
+            counts[start:stop] = np.asarray(both.sum(axis=0), dtype=np.float32).ravel()
+        return counts
+
+    # 精确计算一批规则的指标，rows 为antecedent（矩阵的行基因），cols 为consequent，方向与filter_rules 一致：
+    # confidence 为共现支持度除以consequent 的支持度。count 为已经计算好的共现次数，为None 时通过pair_count 计算
+    def pair_metrics(self, rows, cols, count=None):
+        if count is None:
+            count = self.pair_count(rows, cols)
+        support_m = count / np.float32(self.n_cells)
+        support = self.support_vector
+        batch = metrics_from_support_batch(support_m, support[cols], support[rows])
+        return {
+            "support": support_m,
+            "confidence": batch["confidence"],
+            "lift": batch["lift_ij"],
+            "leverage": batch["leverage_ij"],
+            "conviction": batch["conviction_ij"]
+        }
+
+
+# CSR 矩阵第start到stop行的视图，data 和indices 与原矩阵共享，只复制indptr
+def csr_row_slice(matrix, start, stop):
+    indptr = matrix.indptr[start:stop + 1]
+    begin, end = indptr[0], indptr[-1]
+    return sp.csr_matrix((matrix.data[begin:end], matrix.indices[begin:end], indptr - begin),
+                         shape=(stop - start, matrix.shape[1]), copy=False)
@@ -2,12 +2,13 @@
 import os
 
 import scanpy as sc
-import tensorflow as tf
 import scipy.sparse as sp
 import numpy as np
-import gc
-import sys
+import pandas as pd
 import anndata
+from utils.algorithms.backend import get_backend
+from utils.data_process.matrix_cache import MatrixCache
+from config import Config
 
 '''
 cell_type.tsv 是一个细胞类型注释文件，只有一列，和barcodes.tsv中的barcode一一对应，每个barcode对应一个细胞类型。
@@ -22,32 +23,49 @@ def read_cell_type(file_path):
     return cell_type
 
 
+# 将表达矩阵二值化：表达值不小于threshold 的元素记为1，其余元素（包括显式保存的0）从矩阵中删除。
+# 输入为CSR 矩阵时直接在原矩阵上过滤（会修改输入），复用原来的indptr 和indices，只新建一个dtype 的data 数组，
+# 不生成 (行, 列) 坐标，也不经过COO 格式。dtype 默认为uint8，计算共现次数之前需要转换为float32 等类型，避免溢出
+def binarize_csr(matrix, threshold=1, dtype=np.uint8):
+    if not sp.issparse(matrix):
+        matrix = sp.csr_matrix(matrix)
+    matrix = matrix.tocsr()
+    keep = matrix.data >= threshold
+    if not keep.all():
+        # 将不满足阈值的元素置为0，再原地压缩indices 和data
+        np.logical_not(keep, out=keep)
+        matrix.data[keep] = 0
+        matrix.eliminate_zeros()
+    del keep
+    ones = np.ones(matrix.nnz, dtype=dtype)
+    return sp.csr_matrix((ones, matrix.indices, matrix.indptr), shape=matrix.shape, copy=False)
+
+
 class LoadMatrixDataReal:
     def __init__(self, data_path, cache_path="/home/liuyq/data/ar_data"):
         self.data_path = data_path
         cache_dir = cache_path
         os.environ['SCANPY_TEMPDIR'] = cache_dir
 
-    def load_data(self):
-        adata = sc.read_10x_mtx(self.data_path, var_names='gene_symbols', cache=False)
-        # 设置一个表达阈值，例如1
-        threshold = 1
-
-        # 获取adata.X的行和列索引
-        rows, cols = adata.X.nonzero()
-
-        # 获取非零元素的值
-        values = adata.X.data
-
-        # 应用阈值，将值转换为0和1
-        binary_values = np.where(values >= threshold, 1, 0)
-
-        # 创建一个新的稀疏矩阵，其形状与原始矩阵相同
-        binary_matrix = sp.csr_matrix((binary_values, (rows, cols)), shape=adata.X.shape)
-
-        # 创建一个新的AnnData对象或更新现有的AnnData对象
-        adata_binary = anndata.AnnData(binary_matrix, obs=adata.obs, var=adata.var)
-
+    # threshold 为表达阈值，表达值不小于threshold 的视为表达，见binarize_csr。
+    # use_cache 为True 时解析后的矩阵和二值化后的矩阵都保存在Config.cache_matrix_dir 中，之后直接映射到内存，见matrix_cache.py
+    def load_data(self, threshold=1, dtype=np.uint8, use_cache=None):
+        if use_cache is None:
+            use_cache = Config.matrix_cache
+        if not use_cache:
+            adata = sc.read_10x_mtx(self.data_path, var_names='gene_symbols', cache=False)
+            binary_matrix = binarize_csr(adata.X, threshold=threshold, dtype=dtype)
+            return anndata.AnnData(binary_matrix, obs=adata.obs, var=adata.var)
+
+        cache = MatrixCache(self.data_path)
+        name = cache.binary_name(threshold, dtype)
+        adata_binary = cache.load(name)
+        if adata_binary is None:
+            adata = cache.read_10x()
+            binary_matrix = binarize_csr(adata.X, threshold=threshold, dtype=dtype)
+            # 创建一个新的AnnData对象或更新现有的AnnData对象
+            adata_binary = anndata.AnnData(binary_matrix, obs=adata.obs, var=adata.var)
+            cache.save(name, adata_binary)
         return adata_binary
 
     # 过滤部分基因，只保留在细胞中表达占比超过0.1的基因
@@ -58,55 +76,95 @@ class LoadMatrixDataReal:
         adata = adata[:, gene_expression_ratio > threshold]
         return adata
 
+    # 每个细胞类型中每个基因在多少个细胞中表达，shape=(细胞类型数, 基因数)。codes 为每个细胞所属细胞类型的编号，
+    # 通过一个 细胞类型 × 细胞 的0/1指示矩阵与表达矩阵相乘，一次遍历表达矩阵得到所有细胞类型的结果
+    @staticmethod
+    def gene_counts_by_group(X, codes, n_groups):
+        n_cells = len(codes)
+        indicator = sp.csr_matrix((np.ones(n_cells, dtype=np.int64), (codes, np.arange(n_cells))), shape=(n_groups, n_cells))
+        counts = indicator @ (X if sp.issparse(X) else np.asarray(X))
+        if sp.issparse(counts):
+            counts = counts.toarray()
+        return np.asarray(counts, dtype=np.int64)
+
+    # 每个细胞类型中每个基因的表达占比（与filter_genes 中的表达占比一致），返回 细胞类型 × 基因 的数据框
+    def gene_prevalence_by_cell_type(self, adata, cell_type):
+        labels, order, offsets = self.partition_by_cell_type(cell_type)
+        sizes = np.diff(offsets)
+        codes = np.empty(len(order), dtype=np.int64)
+        codes[order] = np.repeat(np.arange(len(labels)), sizes)
+        counts = self.gene_counts_by_group(adata.X, codes, len(labels))
+        return pd.DataFrame(counts / sizes[:, None], index=labels, columns=adata.var_names)
+
+    # 每个细胞类型只保留在该细胞类型中表达占比超过threshold 的基因。基因对的支持度不会超过单个基因的支持度，
+    # 因此这里删除的基因不会出现在该细胞类型任何满足支持度阈值的规则中。adata 为split_by_cell_type 之前（或self.adata_sorted）的全部细胞
+    def filter_genes_by_cell_type(self, adata, adata_subs, threshold=0.1):
+        prevalence = self.gene_prevalence_by_cell_type(adata, adata.obs['cell_type'])
+        for cell_type, adata_sub in adata_subs.items():
+            adata_subs[cell_type] = adata_sub[:, (prevalence.loc[cell_type] > threshold).to_numpy()]
+        return adata_subs
+
     # 根据提供的基因名列表，过滤adata中的基因
     def filter_genes_by_name(self, adata, gene_names):
         adata = adata[:, gene_names]
         return adata
 
-    # cell_type 为和adata.obs中的cell_type列对应的cell type名称，根据cell type将adata分成多个子集
+    # 由每个细胞的细胞类型一次得到分组：labels 为按首次出现顺序排列的细胞类型，order 为按细胞类型稳定排序后的细胞下标，
+    # 第k 个细胞类型的细胞为 order[offsets[k]:offsets[k + 1]]
+    @staticmethod
+    def partition_by_cell_type(cell_type):
+        codes, labels = pd.factorize(np.asarray(cell_type))
+        order = np.argsort(codes, kind="stable")
+        offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(labels)), out=offsets[1:])
+        return labels.tolist(), order, offsets
+
+    # cell_type 为和adata.obs中的cell_type列对应的cell type名称，根据cell type将adata分成多个子集。
+    # 细胞只按细胞类型重排一次，之后每个细胞类型是一段连续的行（CSR 中只需要截取indptr 的一段），不再对每个细胞类型做一次布尔比较；
+    # 返回的子集仍然是AnnData 的视图，重排后的adata 保存在 self.adata_sorted 中（见filter_genes_by_cell_type）
     def split_by_cell_type(self, adata, cell_type):
         adata.obs['cell_type'] = cell_type
+        labels, order, offsets = self.partition_by_cell_type(adata.obs['cell_type'])
+        if not np.array_equal(order, np.arange(len(order))):
+            adata = adata[order].copy()
+        self.adata_sorted = adata
         adata_subs = {}
-        for cell_type in adata.obs['cell_type'].unique():
-            adata_sub = adata[adata.obs['cell_type'] == cell_type]
-            adata_subs[cell_type] = adata_sub
+        for k, label in enumerate(labels):
+            adata_subs[label] = adata[int(offsets[k]):int(offsets[k + 1])]
         return adata_subs
 
 
-# class TransformData, transform data to tensorflow tensor
+    # 分层抽样：每个细胞类型中不放回地随机抽取至多sample_size 个细胞，细胞类型的总细胞数保存在 adata.uns["n_cells_full"] 中
+    def subsample_by_cell_type(self, adata_subs, sample_size, seed=0):
+        rng = np.random.default_rng(seed)
+        adata_samples = {}
+        for cell_type, adata_sub in adata_subs.items():
+            n_cells = adata_sub.shape[0]
+            if n_cells > sample_size:
+                index = np.sort(rng.choice(n_cells, size=sample_size, replace=False))
+                adata_sub = adata_sub[index].copy()
+            else:
+                adata_sub = adata_sub.copy()
+            # 已经抽样过的数据保留原来的总细胞数
+            adata_sub.uns["n_cells_full"] = adata_sub.uns.get("n_cells_full", n_cells)
+            adata_samples[cell_type] = adata_sub
+        return adata_samples
+
+# class TransformData, transform data to the matrix used by backend (numpy array or tensorflow tensor)
 class TransformDataReal:
-    def __init__(self, adata):
+    def __init__(self, adata, backend=None):
         self.adata = adata
+        self.backend = get_backend(backend)
 
     def transform_data(self):
-        # 将scipy稀疏矩阵转换为TensorFlow的SparseTensor
-        sys.getsizeof(self.adata)
-        sparse_tensor = tf.sparse.from_dense(self.adata.X.todense())
-        # sparse_tensor = tf.constant(self.adata.X.toarray())
-        # self.adata = None
-        print("稀疏矩阵大小：", tf.size(sparse_tensor))
-        data = tf.cast(sparse_tensor, tf.float32)
-        print("float32大小：", tf.size(data))
-        # 将data转置
-        data = tf.sparse.transpose(data)
-        # data = tf.cast(data>0, tf.float32)
-        del sparse_tensor
-        gc.collect()
-        # 将data转置
+        # 稀疏矩阵的转置不需要复制数据，转置之后直接转换为 基因 × 细胞 的float32稠密矩阵
+        data = self.adata.X
+        if sp.issparse(data):
+            data = data.T
+        else:
+            data = np.transpose(data)
+        dense_tensor = self.backend.from_numpy(data)
         print("load data success")
-        # print(data)
-        # # 如果需要，将SparseTensor转换为密集Tensor
-        dense_tensor = tf.sparse.to_dense(data)
-        # dense_tensor = sparse_tensor
-        # data = dense_tensor
-        # #data = tf.cast(dense_tensor, tf.float32)
-        # #将data 矩阵转化为0,1矩阵
-        # #data = tf.where(data < 0.5, tf.zeros_like(data), tf.ones_like(data))
-        # #将data转置
-        # data = tf.cast(data, tf.bool)
-        # gc.collect()
-        # data = tf.transpose(data)
-
         return dense_tensor
 
     def get_data(self):
@@ -123,6 +181,30 @@ class TransformDataReal:
         return self.tf_data, self.adata.var_names, self.adata.obs_names
 
 
+# 不做稠密化，直接返回二值化后的 细胞 × 基因 的CSR矩阵，供SparseMatrixRule使用
+class TransformDataSparse:
+    def __init__(self, adata):
+        self.adata = adata
+        self.sparse_data = None
+
+    def transform_data(self):
+        data = self.adata.X
+        if not sp.issparse(data):
+            data = sp.csr_matrix(data)
+        data = data.tocsr()
+        return data
+
+    def get_genes_info(self):
+        return self.adata.var_names
+
+    def get_cells_info(self):
+        return self.adata.obs_names
+
+    def run(self):
+        self.sparse_data = self.transform_data()
+        return self.sparse_data, self.adata.var_names, self.adata.obs_names
+
+
 # 测试加载数据
 if __name__ == '__main__':
     data_path = r'/mnt/sda/liuyq/ar_data/sc_data/liver'
@@ -19,20 +19,20 @@ class LoadMatrixData:
         _data = pd.read_csv(self.file_path, sep='\t', index_col=0)
         return _data
 
-# 将pandas dataframe转化为tensorflow tensor, 列名赋给自身的cells_info属性, 行名赋给自身的genes_info属性, 将cells_info属性和genes_info属性转换为字符串类型
-import tensorflow as tf
+# 将pandas dataframe转化为后端使用的矩阵（numpy array 或 tensorflow tensor）, 列名赋给自身的cells_info属性, 行名赋给自身的genes_info属性, 将cells_info属性和genes_info属性转换为字符串类型
+from utils.algorithms.backend import get_backend
 
 
 class TransformData:
-    def __init__(self, data):
+    def __init__(self, data, backend=None):
         self.data = data
         self.genes_info = data.index.astype(str).to_list()
         self.cells_info = data.columns.astype(str).to_list()
         self.tf_data = None
+        self.backend = get_backend(backend)
 
     def transform_data(self):
-        data = tf.convert_to_tensor(self.data.values)
-        data = tf.cast(data, tf.float32)
+        data = self.backend.from_numpy(self.data.values)
         return data
 
     def get_data(self):
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import shutil
+
+import anndata
+import numpy as np
+import pandas as pd
+import scanpy as sc
+import scipy.sparse as sp
+from config import Config
+
+'''
+10x 表达矩阵的二进制缓存。sc.read_10x_mtx 解析文本格式的matrix.mtx 很慢，而同一份数据在每次运行中都会被读取多次
+（LoadMatrixDataReal.load_data 以及DiffereceGene.load_data）。这里按10x 文件夹中文件的大小和修改时间（可选文件内容的哈希）
+计算指纹，将解析后的矩阵以及二值化后的矩阵分别保存为CSR 的三个 .npy 数组（data, indices, indptr），以及细胞和基因的注释（.df），
+保存在 Config.cache_matrix_dir/<指纹>/ 下；之后的运行通过np.load(mmap_mode=...) 直接映射到内存，不需要重新解析。
+数据文件发生变化时指纹随之变化，旧的缓存不会被使用。
+'''
+
+_10x_files = ("matrix.mtx", "features.tsv", "genes.tsv", "barcodes.tsv")
+
+
+# 10x 文件夹的指纹：文件名、大小和修改时间，hash_content 为True 时同时计算文件内容的sha1（较慢，但不受文件复制、touch 的影响）
+def fingerprint_10x(data_path, hash_content=False):
+    digest = hashlib.sha1()
+    for name in _10x_files:
+        for suffix in ("", ".gz"):
+            file_path = os.path.join(data_path, name + suffix)
+            if not os.path.exists(file_path):
+                continue
+            stat = os.stat(file_path)
+            digest.update(f"{name}{suffix}:{stat.st_size}".encode())
+            if hash_content:
+                with open(file_path, "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(block)
+            else:
+                digest.update(f":{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+# 将CSR 矩阵保存为文件夹中的三个 .npy 文件以及记录形状的meta.json
+def save_csr(dir_path, matrix):
+    matrix = sp.csr_matrix(matrix)
+    os.makedirs(dir_path, exist_ok=True)
+    np.save(os.path.join(dir_path, "data.npy"), matrix.data)
+    np.save(os.path.join(dir_path, "indices.npy"), matrix.indices)
+    np.save(os.path.join(dir_path, "indptr.npy"), matrix.indptr)
+    with open(os.path.join(dir_path, "meta.json"), "w") as f:
+        json.dump({"shape": list(matrix.shape)}, f)
+
+
+# 读取save_csr 保存的矩阵。mmap_mode 默认为 "c"（写时复制）：数组直接映射到内存，修改只发生在内存中，不会改变缓存文件
+def load_csr(dir_path, mmap_mode="c"):
+    with open(os.path.join(dir_path, "meta.json")) as f:
+        shape = tuple(json.load(f)["shape"])
+    data = np.load(os.path.join(dir_path, "data.npy"), mmap_mode=mmap_mode)
+    indices = np.load(os.path.join(dir_path, "indices.npy"), mmap_mode=mmap_mode)
+    indptr = np.load(os.path.join(dir_path, "indptr.npy"), mmap_mode=mmap_mode)
+    return sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+class MatrixCache:
+    '''
+    data_path 为10x 数据的文件夹，cache_dir 为缓存的根目录，默认为Config.cache_matrix_dir。
+    每个矩阵保存在 cache_dir/<指纹>/<name>/ 中，name 为 "raw"（read_10x_mtx 的结果）或者binary_name 给出的二值化矩阵的名字。
+    '''
+
+    def __init__(self, data_path, cache_dir=None, hash_content=None):
+        self.data_path = data_path
+        self.cache_dir = cache_dir if cache_dir is not None else Config.cache_matrix_dir
+        self.hash_content = hash_content if hash_content is not None else Config.matrix_cache_hash_content
+        self.fingerprint = fingerprint_10x(data_path, hash_content=self.hash_content)
+        self.dir_path = os.path.join(self.cache_dir, self.fingerprint)
+
+    @staticmethod
+    def binary_name(threshold, dtype):
+        return f"binary_{threshold}_{np.dtype(dtype).name}"
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.dir_path, name, "meta.json"))
+
+    # 读取缓存的AnnData，不存在时返回None
+    def load(self, name, mmap_mode="c"):
+        if not self.exists(name):
+            return None
+        dir_path = os.path.join(self.dir_path, name)
+        matrix = load_csr(dir_path, mmap_mode=mmap_mode)
+        obs = pd.read_pickle(os.path.join(dir_path, "obs.df"))
+        var = pd.read_pickle(os.path.join(dir_path, "var.df"))
+        print("load matrix from cache:", dir_path)
+        return anndata.AnnData(matrix, obs=obs, var=var)
+
+    # 保存AnnData 的表达矩阵以及细胞、基因的注释。先写入临时文件夹再重命名，写入中断时不会留下不完整的缓存
+    def save(self, name, adata):
+        dir_path = os.path.join(self.dir_path, name)
+        tmp_path = f"{dir_path}.tmp{os.getpid()}"
+        save_csr(tmp_path, adata.X)
+        adata.obs.to_pickle(os.path.join(tmp_path, "obs.df"))
+        adata.var.to_pickle(os.path.join(tmp_path, "var.df"))
+        if self.exists(name):
+            shutil.rmtree(tmp_path)
+            return
+        os.replace(tmp_path, dir_path)
+        print("finish saving matrix cache to", dir_path)
+
+    # 与sc.read_10x_mtx(data_path, var_names='gene_symbols') 一致，优先从缓存中读取
+    def read_10x(self):
+        adata = self.load("raw")
+        if adata is None:
+            adata = sc.read_10x_mtx(self.data_path, var_names='gene_symbols', cache=False)
+            self.save("raw", adata)
+        return adata
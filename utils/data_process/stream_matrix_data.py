@@ -0,0 +1,158 @@
+import gzip
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from utils.algorithms.incremental_association_rule import CooccurrenceAccumulator, add_chunk_by_group
+
+'''
+流式读取10x的 matrix.mtx(.gz)，不把整个表达矩阵读入内存。
+matrix.mtx 为MatrixMarket 坐标格式，每一行为 "基因 细胞 表达值"（从1开始编号），CellRanger 输出的文件按细胞（barcode）排序。
+每次读取chunk_size 个非零元素，应用表达阈值之后，把已经读完的细胞按细胞类型直接累加到每个细胞类型的共现次数中，
+峰值内存只与chunk_size 以及 基因 × 基因 的计数有关，与细胞数无关。
+'''
+
+
+# 返回文件路径，优先使用未压缩的文件
+def find_file(data_path, names):
+    for name in names:
+        for suffix in ("", ".gz"):
+            file_path = os.path.join(data_path, name + suffix)
+            if os.path.exists(file_path):
+                return file_path
+    raise FileNotFoundError(f"none of {names} found in {data_path}")
+
+
+def open_text(file_path):
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rt")
+    return open(file_path, "r")
+
+
+# 与scanpy.read_10x_mtx(make_unique=True) 一致，重复的基因名依次加上 -1, -2, ...
+def make_unique(names):
+    names = pd.Index(names)
+    duplicated = names.duplicated(keep="first")
+    if not duplicated.any():
+        return names
+    names = names.to_numpy(dtype=object).copy()
+    seen = set(names)
+    counter = {}
+    for index in np.flatnonzero(duplicated):
+        name = names[index]
+        count = counter.get(name, 0)
+        while True:
+            count += 1
+            new_name = f"{name}-{count}"
+            if new_name not in seen:
+                break
+        counter[name] = count
+        names[index] = new_name
+        seen.add(new_name)
+    return pd.Index(names)
+
+
+class StreamMatrixData:
+    '''
+    data_path 为10x数据的文件夹（matrix.mtx, features.tsv/genes.tsv, barcodes.tsv，可以为.gz 压缩文件）。
+    threshold 为表达阈值，与LoadMatrixDataReal.load_data 一致，表达值不小于threshold 的视为表达。
+    chunk_size 为每次读取的非零元素个数。
+    '''
+
+    def __init__(self, data_path, threshold=1, chunk_size=2_000_000):
+        self.data_path = data_path
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.matrix_fp = find_file(data_path, ["matrix.mtx"])
+        self.features_fp = find_file(data_path, ["features.tsv", "genes.tsv"])
+
+    # 读取文件头，返回 (基因数, 细胞数, 非零元素个数, 文件头的行数)
+    def read_header(self):
+        n_header = 0
+        with open_text(self.matrix_fp) as f:
+            for line in f:
+                n_header += 1
+                if not line.startswith("%"):
+                    n_genes, n_cells, nnz = (int(value) for value in line.split())
+                    return n_genes, n_cells, nnz, n_header
+        raise ValueError(f"{self.matrix_fp} has no size line")
+
+    # 基因名（gene symbol，与load_data 中的 var_names='gene_symbols' 一致）
+    def read_genes(self):
+        features = pd.read_csv(self.features_fp, sep="\t", header=None)
+        column = 1 if features.shape[1] > 1 else 0
+        return make_unique(features[column].astype(str))
+
+    # 依次返回每一块满足阈值的元素 (基因, 细胞)，均为从0开始的编号
+    def iter_entries(self):
+        _, _, _, n_header = self.read_header()
+        reader = pd.read_csv(self.matrix_fp, sep=r"\s+", header=None, skiprows=n_header, chunksize=self.chunk_size,
+                             dtype={0: np.int64, 1: np.int64, 2: np.float64})
+        for chunk in reader:
+            values = chunk.to_numpy()
+            keep = values[:, 2] >= self.threshold
+            yield values[keep, 0].astype(np.int64) - 1, values[keep, 1].astype(np.int64) - 1
+
+    # 第一遍读取：每个基因在多少个细胞中表达，不要求元素按细胞排序
+    def gene_counts(self):
+        n_genes, _, _, _ = self.read_header()
+        counts = np.zeros(n_genes, dtype=np.int64)
+        for genes, _ in self.iter_entries():
+            counts += np.bincount(genes, minlength=n_genes)
+        return counts
+
+    # 依次返回已经读完的细胞 (cell_start, 细胞 × 选中基因 的二值CSR矩阵)，矩阵的第k行为第cell_start + k 个细胞，
+    # 没有表达任何选中基因的细胞对应空行。gene_index 为每个基因在选中基因中的列号，未选中的为-1
+    def iter_cell_chunks(self, gene_index, n_selected):
+        _, n_cells, _, _ = self.read_header()
+        cell_start = 0
+        pending_genes = np.empty(0, dtype=np.int64)
+        pending_cells = np.empty(0, dtype=np.int64)
+        for genes, cells in self.iter_entries():
+            if len(cells) == 0:
+                continue
+            if cells[0] < cell_start or (np.diff(cells) < 0).any() or \
+                    (len(pending_cells) > 0 and cells[0] < pending_cells[-1]):
+                raise ValueError("entries of matrix.mtx should be sorted by cell (barcode) for streaming")
+            genes = np.concatenate([pending_genes, genes])
+            cells = np.concatenate([pending_cells, cells])
+            # 最后一个细胞可能还有元素在下一块中，留到下一块处理
+            cell_stop = cells[-1]
+            complete = cells < cell_stop
+            pending_genes, pending_cells = genes[~complete], cells[~complete]
+            if cell_stop > cell_start:
+                yield cell_start, self._to_csr(genes[complete], cells[complete], cell_start, cell_stop,
+                                               gene_index, n_selected)
+                cell_start = cell_stop
+        yield cell_start, self._to_csr(pending_genes, pending_cells, cell_start, n_cells, gene_index, n_selected)
+
+    @staticmethod
+    def _to_csr(genes, cells, cell_start, cell_stop, gene_index, n_selected):
+        columns = gene_index[genes]
+        keep = columns >= 0
+        ones = np.ones(np.count_nonzero(keep), dtype=np.float32)
+        return sp.csr_matrix((ones, (cells[keep] - cell_start, columns[keep])),
+                             shape=(cell_stop - cell_start, n_selected))
+
+    # 流式计算每个细胞类型的共现次数。cell_type 为每个细胞的细胞类型（与barcodes.tsv 一一对应，见read_cell_type），
+    # genes_info 为使用的基因名，为None 时先读取一遍文件，保留在所有细胞中表达占比超过min_support 的基因（与filter_genes 一致）。
+    # 返回 {cell_type: CooccurrenceAccumulator}
+    def accumulate_by_group(self, cell_type, genes_info=None, min_support=0.1, batch_id=0, max_bytes=None):
+        all_genes = self.read_genes()
+        _, n_cells, _, _ = self.read_header()
+        labels, codes = np.unique(np.asarray(cell_type), return_inverse=True)
+        if len(codes) != n_cells:
+            raise ValueError("cell_type should have one entry per barcode")
+        if genes_info is None:
+            genes_info = all_genes[self.gene_counts() / n_cells > min_support]
+        genes_info = pd.Index(genes_info)
+        gene_index = genes_info.get_indexer(all_genes)
+        labels = labels.tolist()
+        accumulators = {label: CooccurrenceAccumulator(genes_info, max_bytes=max_bytes) for label in labels}
+        for cell_start, chunk in self.iter_cell_chunks(gene_index, len(genes_info)):
+            chunk_codes = codes[cell_start:cell_start + chunk.shape[0]]
+            add_chunk_by_group(accumulators, labels, chunk, chunk_codes)
+        for accumulator in accumulators.values():
+            accumulator.batches[batch_id] = accumulator.n_cells
+        return accumulators
@@ -5,8 +5,20 @@ import config
 from utils.data_process.read_cell_type import read_cell_type
 from utils.data_process.load_data import LoadMatrixDataReal
 from utils.data_process.load_data import TransformDataReal
+from utils.data_process.load_data import TransformDataSparse
+from utils.data_process.stream_matrix_data import StreamMatrixData
+from utils.algorithms.association_rule import AssociationRule
 from utils.algorithms.matrix_association_rule import MatrixRule
+from utils.algorithms.matrix_association_rule_block import MatrixRuleBlock
+from utils.algorithms.sparse_association_rule import SparseMatrixRule
+from utils.algorithms.bit_association_rule import BitMatrixRule
+from utils.algorithms.itemset_association_rule import ItemsetRule
+from utils.algorithms.count_association_rule import CountMatrixRule
+from utils.algorithms.minhash_association_rule import MinHashRule
+from utils.algorithms.sampling_association_rule import add_confidence_intervals
+from utils.algorithms.incremental_association_rule import CooccurrenceAccumulator, accumulate_by_group
 import os
+import pandas as pd
 from utils.data_process.ar_metrics_process import SaveArMetrics, LoadArMetrics, FilterArMetrics
 from utils.data_process.read_gene_list import read_gene_list
 from utils.pipe_analysis.subnet_detection import Graph
@@ -14,9 +26,10 @@ from utils.pipe_analysis.gsea import GSEA
 from utils.data_process.merge_network import MergeNetwork
 from utils.data_process.gene_selection import GeneSelection
 from utils.pipe_analysis.deg import DiffereceGene
+from utils.pipe_analysis.parallel_pipe import run_ar_parallel
 from config import Config
 from utils.data_process.ar_metrics_process import SaveArMetrics, LoadArMetrics
-from utils.data_process.pickle_unpicle import pickle_data, unpickle_data
+from utils.data_process.pickle_unpicle import pickle_data, unpickle_data, pickle_python_object
 from utils.pipe_analysis.interaction_type_ar_metrics_statistics import NetworkIntegration, Statistics
 class CellTypePipe:
     def __init__(self, data_path,
@@ -31,30 +44,59 @@ class CellTypePipe:
         self.cell_type_path = cell_type_fp
         self.threshold_dict = threshold_dict
         self.min_support = threshold_dict["support"][0]
+        # get_degs 的结果以及对应的数据指纹，数据不变时不重新计算
+        self.degs = None
+        self.degs_fingerprint = None
 
     def reset_threshold(self, threshold_dict):
         self.threshold_dict = threshold_dict
         self.min_support = threshold_dict["support"][0]
 
-    def read_data(self, min_support=None):
+    # sample_size 不为None 时，每个细胞类型随机抽取至多sample_size 个细胞，用于快速探索阈值，见run_ar_sampled。
+    # by_cell_type 为True 时按每个细胞类型内的表达占比过滤基因（见filter_genes_by_cell_type），否则按全部细胞过滤，默认为Config.filter_genes_by_cell_type
+    def read_data(self, min_support=None, sample_size=None, seed=0, by_cell_type=None):
+        if by_cell_type is None:
+            by_cell_type = Config.filter_genes_by_cell_type
         # 加载数据
         data_obj = LoadMatrixDataReal(self.data_path)
         _data = data_obj.load_data()
-        _data = data_obj.filter_genes(_data, threshold=min_support)
+        if not by_cell_type:
+            _data = data_obj.filter_genes(_data, threshold=min_support)
 
         # 读取cell_type.tsv文件
         cell_type = read_cell_type(self.cell_type_path)
         adata_subs = data_obj.split_by_cell_type(_data, cell_type)
+        if by_cell_type:
+            adata_subs = data_obj.filter_genes_by_cell_type(data_obj.adata_sorted, adata_subs, threshold=min_support)
+        if sample_size is not None:
+            adata_subs = data_obj.subsample_by_cell_type(adata_subs, sample_size, seed=seed)
         return adata_subs, data_obj
 
+    # 所有细胞类型的差异基因只计算一次：同一个对象中保存在self.degs 中，同时按指纹（数据、细胞类型注释和Config.deg_threshold_dict）
+    # 保存在Config.cache_deg_dir 中，之后的运行在指纹相同时直接读取，不再重新加载数据和计算
     def get_degs(self, ):
         diff_gene = DiffereceGene(data_path=self.data_path, cell_type_fn=self.cell_type_path)
-        adata = diff_gene.load_data()
-        adata = diff_gene.assign_cell_type(adata)
-        adata = diff_gene.preprocess(adata)
-        diff_gene.get_diff_genes(adata)
-        degs = diff_gene.deg_dict
-        diff_gene.save_deg_df_dict()
+        fingerprint = diff_gene.fingerprint()
+        if self.degs_fingerprint == fingerprint:
+            return self.degs
+        cache_fp = os.path.join(Config.cache_deg_dir, fingerprint + ".obj")
+        cache = unpickle_data(cache_fp) if os.path.exists(cache_fp) else None
+        # 缓存中同时保存deg_dict 和deg_df_dict，旧版本的缓存只有deg_dict，无法写出差异基因的文件，需要重新计算
+        if isinstance(cache, dict) and set(cache) == {"deg_dict", "deg_df_dict"}:
+            degs = cache["deg_dict"]
+            # Config.deg_fp 可能已经被DirManager.clean_results_dir 清空，补写缺少的文件
+            diff_gene.deg_df_dict = cache["deg_df_dict"]
+            diff_gene.save_deg_df_dict(overwrite=False)
+        else:
+            adata = diff_gene.load_data()
+            adata = diff_gene.assign_cell_type(adata)
+            adata = diff_gene.preprocess(adata)
+            diff_gene.get_diff_genes(adata)
+            degs = diff_gene.deg_dict
+            diff_gene.save_deg_df_dict()
+            os.makedirs(Config.cache_deg_dir, exist_ok=True)
+            pickle_python_object({"deg_dict": degs, "deg_df_dict": diff_gene.deg_df_dict}, cache_fp)
+        self.degs, self.degs_fingerprint = degs, fingerprint
         return degs
 
     def bio_network(self, bionet_fp_dict=None):
@@ -75,11 +117,12 @@ class CellTypePipe:
         return merge_network
 
     def subset_by_genes(self, adata_subs, bionet_fp_dict, deg_sel=True, network_sel=True):
+        # 差异基因对所有细胞类型只计算一次
+        degs = self.get_degs() if deg_sel else None
         for cell_type, adata in adata_subs.items():
             gene_selector = GeneSelection(adata)
             if deg_sel:
                 # get seed genes from degs
-                degs = self.get_degs()
                 seed_genes = degs[cell_type]
                 gene_selector.set_seed_genes(seed_genes)
                 target_genes = seed_genes
@@ -112,16 +155,220 @@ class CellTypePipe:
             adata_subs[cell_type] = adata
         return adata_subs
 
-    def run_ar(self, adata_subs):
+    # engine 为关联规则的计算引擎：matrix 一次性计算所有基因对，block 按基因分块计算，单块内存不超过max_bytes，
+    # sparse 直接在稀疏矩阵上按块计算，不生成稠密的表达矩阵，bit 将每个基因压缩为uint64位向量，通过按位与和popcount统计共现次数（只节省内存，比block 慢），
+    # count 只保存整数形式的共现次数，指标在需要时再计算，minhash 通过MinHash/LSH 只对候选基因对精确计算（近似，用于run_ar_pruned）。
+    # max_bytes 只限制分块计算时每一块的临时矩阵；通过run_ar 输出所有基因对的指标时，任何引擎都需要 5 个 n_gene × n_gene 的float32 矩阵
+    # 以及由它们合并而成的数据框，基因数很多时应使用run_ar_pruned
+    def build_ar_engine(self, adata, engine="matrix", max_bytes=None):
+        if max_bytes is None:
+            max_bytes = Config.ar_max_bytes
+        if engine == "matrix":
+            data, genes_info, cells_info = TransformDataReal(adata, backend=Config.ar_backend).run()
+            mar_obj = MatrixRule(data, genes_info, cells_info, backend=Config.ar_backend)
+        elif engine == "block":
+            data, genes_info, cells_info = TransformDataReal(adata, backend=Config.ar_backend).run()
+            mar_obj = MatrixRuleBlock(data, genes_info, cells_info, max_bytes=max_bytes,
+                                      symmetric=Config.ar_symmetric, backend=Config.ar_backend)
+        elif engine == "sparse":
+            data, genes_info, cells_info = TransformDataSparse(adata).run()
+            mar_obj = SparseMatrixRule(data, genes_info, cells_info, max_bytes=max_bytes, symmetric=Config.ar_symmetric)
+        elif engine == "bit":
+            data, genes_info, cells_info = TransformDataSparse(adata).run()
+            mar_obj = BitMatrixRule(data, genes_info, cells_info, max_bytes=max_bytes, symmetric=Config.ar_symmetric)
+        elif engine == "count":
+            data, genes_info, cells_info = TransformDataSparse(adata).run()
+            mar_obj = CountMatrixRule.from_sparse(data, genes_info, cells_info, max_bytes=max_bytes,
+                                                  symmetric=Config.ar_symmetric)
+        elif engine == "minhash":
+            data, genes_info, cells_info = TransformDataSparse(adata).run()
+            mar_obj = MinHashRule(data, genes_info, cells_info, n_hashes=Config.minhash_n_hashes,
+                                  jaccard_threshold=Config.minhash_jaccard_threshold, max_bytes=max_bytes)
+        else:
+            raise ValueError("engine should be matrix, block, sparse, bit, count or minhash")
+        mar_obj.cache_max_bytes = Config.ar_cache_max_bytes
+        return mar_obj
+
+    # run_ar 需要为每个细胞类型生成所有基因对的指标矩阵（5 个 n_gene × n_gene 的float32 矩阵，合并为数据框时再复制一份），
+    # 超过max_bytes 时提示使用run_ar_pruned，max_bytes 为None 时使用MatrixRuleBlock.default_max_bytes
+    def check_ar_output_size(self, adata_subs, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = Config.ar_max_bytes if Config.ar_max_bytes is not None else MatrixRuleBlock.default_max_bytes
+        for cell_type, adata in adata_subs.items():
+            n_genes = adata.shape[1]
+            output_bytes = 2 * len(MatrixRuleBlock.metric_names) * n_genes * n_genes * 4
+            if output_bytes > max_bytes:
+                print(f"warning: run_ar for {cell_type} needs about {output_bytes / 1024 ** 3:.1f}GB for all {n_genes}^2 "
+                      f"gene pairs, which is not bounded by max_bytes; use run_ar_pruned to apply the thresholds while computing")
+
+    # n_workers 大于1 时使用进程池同时计算多个细胞类型，每个进程的线程数为threads_per_worker，见parallel_pipe.py
+    def run_ar(self, adata_subs, engine=None, max_bytes=None, n_workers=None, threads_per_worker=None):
+        if engine is None:
+            engine = Config.ar_engine
+        if n_workers is None:
+            n_workers = Config.ar_n_workers
+        if threads_per_worker is None:
+            threads_per_worker = Config.ar_threads_per_worker
+        self.check_ar_output_size(adata_subs, max_bytes)
+        if n_workers > 1 and len(adata_subs) > 1:
+            return run_ar_parallel(self, adata_subs, engine, max_bytes=max_bytes, n_workers=n_workers,
+                                   threads_per_worker=threads_per_worker)
         results = {}
         for cell_type, adata in adata_subs.items():
-            transform_data_obj = TransformDataReal(adata)
-            data, genes_info, cells_info = transform_data_obj.run()
-            mar_obj = MatrixRule(data, genes_info, cells_info)
+            mar_obj = self.build_ar_engine(adata, engine=engine, max_bytes=max_bytes)
             metrics = mar_obj.all_metrics_to_dataframe
+            # 只保留最终的数据框，释放所有中间结果
+            mar_obj.release()
             results[cell_type] = metrics
         return results
 
+    # 在计算关联规则时直接应用阈值，返回的结果与 filter_transform_to_edge_style(transform_to_edge_style(run_ar())) 结构一致，
+    # 但不需要生成所有基因对的指标矩阵；matrix 引擎不支持分块，这里使用结果相同的block 引擎代替。
+    # pvalue 为True 时增加一列共现的超几何检验p值，threshold_dict 中也可以设置 "p_value" 的阈值
+    def run_ar_pruned(self, adata_subs, engine=None, max_bytes=None, threshold_dict=None, pvalue=False):
+        if engine is None:
+            engine = Config.ar_engine
+        if engine == "matrix":
+            engine = "block"
+        if threshold_dict is None:
+            threshold_dict = self.threshold_dict
+        results = {}
+        for cell_type, adata in adata_subs.items():
+            mar_obj = self.build_ar_engine(adata, engine=engine, max_bytes=max_bytes)
+            results[cell_type] = mar_obj.filter_rules(threshold_dict, pvalue=pvalue)
+            mar_obj.release()
+        return results
+
+    # 在抽样的细胞上估计指标并应用阈值，返回的边列表增加支持度和置信度的置信区间（support_low 等四列）。
+    # adata_subs 为read_data(sample_size=...) 的结果，或者全部细胞（此时由sample_size 在这里抽样）。
+    # adata_subs_full 不为None 时，在全部细胞上对保留下来的规则精确地重新计算指标，并按threshold_dict 再次过滤
+    def run_ar_sampled(self, adata_subs, sample_size=None, threshold_dict=None, adata_subs_full=None, level=0.95,
+                       max_bytes=None, seed=0):
+        if threshold_dict is None:
+            threshold_dict = self.threshold_dict
+        if max_bytes is None:
+            max_bytes = Config.ar_max_bytes
+        if sample_size is not None:
+            adata_subs = LoadMatrixDataReal(self.data_path).subsample_by_cell_type(adata_subs, sample_size, seed=seed)
+        results = {}
+        for cell_type, adata in adata_subs.items():
+            data, genes_info, cells_info = TransformDataSparse(adata).run()
+            mar_obj = SparseMatrixRule(data, genes_info, cells_info, max_bytes=max_bytes, symmetric=Config.ar_symmetric)
+            df = mar_obj.filter_rules(threshold_dict)
+            df = add_confidence_intervals(df, mar_obj, n_population=adata.uns.get("n_cells_full"), level=level)
+            if adata_subs_full is not None:
+                df = self.rescore_rules(adata_subs_full[cell_type], df, threshold_dict, max_bytes=max_bytes)
+            results[cell_type] = df
+        return results
+
+    # 在全部细胞上精确计算边列表中规则的指标，替换估计值并按threshold_dict 重新过滤，置信区间的列会被删除
+    def rescore_rules(self, adata, df, threshold_dict, max_bytes=None):
+        data, genes_info, cells_info = TransformDataSparse(adata).run()
+        mar_obj = SparseMatrixRule(data, genes_info, cells_info, max_bytes=max_bytes)
+        genes = pd.Index(genes_info)
+        rows = genes.get_indexer(df["antecedent"])
+        cols = genes.get_indexer(df["consequent"])
+        if (rows < 0).any() or (cols < 0).any():
+            raise ValueError("df contains genes that are not in adata")
+        metrics = mar_obj.pair_metrics(rows, cols)
+        exact = pd.DataFrame({"antecedent": df["antecedent"].to_numpy(), "consequent": df["consequent"].to_numpy()})
+        for key in mar_obj.metric_names:
+            exact[key] = metrics[key]
+        results_filter = FilterArMetrics({}, threshold_dict=threshold_dict)
+        return results_filter.filter_pairs_in_df(exact, threshold_dict)
+
+    # 对过滤后的边列表（filter_transform_to_edge_style 或 run_ar_pruned 的结果）增加一列BH校正后的q值，
+    # 多重检验的总数为该细胞类型中所有的基因对，所有基因对的p值按块流式地计算，不需要保存全部的p值
+    def add_qvalues(self, adata_subs, results, engine=None, max_bytes=None):
+        if engine is None:
+            engine = Config.ar_engine
+        if engine == "matrix":
+            engine = "block"
+        results_q = {}
+        for cell_type, df in results.items():
+            mar_obj = self.build_ar_engine(adata_subs[cell_type], engine=engine, max_bytes=max_bytes)
+            results_q[cell_type] = mar_obj.qvalues(df)
+        return results_q
+
+    # 挖掘 (A, B) -> C 形式的三基因关联规则，只有支持度大于min_support 的基因对才会用于生成候选三元组
+    def run_itemset(self, adata_subs, min_support=None, max_bytes=None, n_jobs=None):
+        if min_support is None:
+            min_support = Config.min_support
+        if max_bytes is None:
+            max_bytes = Config.ar_max_bytes
+        results = {}
+        for cell_type, adata in adata_subs.items():
+            data, genes_info, cells_info = TransformDataSparse(adata).run()
+            itemset_obj = ItemsetRule(data, genes_info, cells_info, min_support=min_support,
+                                      max_bytes=max_bytes, n_jobs=n_jobs)
+            results[cell_type] = itemset_obj.all_triple_rules_to_dataframe
+        return results
+
+    # 在一次遍历中计算所有细胞类型的共现次数，不需要split_by_cell_type 切分数据，也不需要把每个细胞类型的数据转换为稠密矩阵。
+    # 所有细胞类型使用相同的基因（在全部细胞上按min_support 过滤，与read_data 一致），返回 {cell_type: CountMatrixRule}
+    def run_ar_grouped(self, min_support=None, chunk_size=4096, max_bytes=None):
+        if min_support is None:
+            min_support = self.min_support
+        if max_bytes is None:
+            max_bytes = Config.ar_max_bytes
+        data_obj = LoadMatrixDataReal(self.data_path)
+        _data = data_obj.load_data()
+        _data = data_obj.filter_genes(_data, threshold=min_support)
+        cell_type = read_cell_type(self.cell_type_path)
+        accumulators = accumulate_by_group(_data.X, cell_type, _data.var_names, chunk_size=chunk_size, max_bytes=max_bytes)
+        results = {}
+        for cell_type, accumulator in accumulators.items():
+            results[cell_type] = accumulator.to_rule()
+        return results
+
+    # 与run_ar_grouped 相同，但不调用sc.read_10x_mtx 读入整个矩阵，而是流式读取matrix.mtx，每次读取chunk_size 个非零元素，
+    # 峰值内存只与chunk_size 以及 基因 × 基因 的计数有关。返回 {cell_type: CountMatrixRule}
+    def run_ar_streaming(self, min_support=None, chunk_size=2_000_000, threshold=1, max_bytes=None):
+        if min_support is None:
+            min_support = self.min_support
+        if max_bytes is None:
+            max_bytes = Config.ar_max_bytes
+        stream_obj = StreamMatrixData(self.data_path, threshold=threshold, chunk_size=chunk_size)
+        cell_type = read_cell_type(self.cell_type_path)
+        accumulators = stream_obj.accumulate_by_group(cell_type, min_support=min_support, max_bytes=max_bytes)
+        results = {}
+        for cell_type, accumulator in accumulators.items():
+            results[cell_type] = accumulator.to_rule()
+        return results
+
+    # 将一批新的10x数据（batch_path 下的matrix.mtx 等文件及其cell_type.tsv）加入每个细胞类型的累加器，remove 为True时从累加器中删除该批次，
+    # 旧的细胞不需要重新读取和计算。累加器保存在Config.cache_accumulator_dir 下，第一次创建时使用该批次中支持度大于min_support 的基因。
+    # 返回 {cell_type: CountMatrixRule}，可以继续调用filter_rules 或 all_metrics_to_dataframe
+    def run_ar_incremental(self, batch_path, batch_cell_type_fp, batch_id, remove=False, min_support=None, max_bytes=None):
+        if min_support is None:
+            min_support = self.min_support
+        if max_bytes is None:
+            max_bytes = Config.ar_max_bytes
+        if not os.path.exists(Config.cache_accumulator_dir):
+            os.makedirs(Config.cache_accumulator_dir)
+        data_obj = LoadMatrixDataReal(batch_path)
+        _data = data_obj.load_data()
+        cell_type = read_cell_type(batch_cell_type_fp)
+        adata_subs = data_obj.split_by_cell_type(_data, cell_type)
+        results = {}
+        for cell_type, adata in adata_subs.items():
+            accumulator_fp = os.path.join(Config.cache_accumulator_dir, cell_type + "_accumulator.obj")
+            if os.path.exists(accumulator_fp):
+                accumulator = CooccurrenceAccumulator.load(accumulator_fp)
+            elif remove:
+                raise ValueError(f"no accumulator for cell type {cell_type}")
+            else:
+                genes_info = data_obj.filter_genes(adata, threshold=min_support).var_names
+                accumulator = CooccurrenceAccumulator(genes_info, max_bytes=max_bytes)
+            if remove:
+                accumulator.remove_batch(batch_id, adata.X, adata.var_names)
+            else:
+                accumulator.add_batch(batch_id, adata.X, adata.var_names)
+            accumulator.save(accumulator_fp)
+            if accumulator.n_cells > 0:
+                results[cell_type] = accumulator.to_rule()
+        return results
+
     def filter_result(self, results):
         results_filter = FilterArMetrics(results, threshold_dict=self.threshold_dict)
         res1 = results_filter.filter_result()
@@ -153,6 +400,28 @@ class CellTypePipe:
         res1 = results_filter.extract_by_gene_pairs(gene_pair, results)
         return res1
 
+    # 只计算给定基因对的指标，gene_pairs 的结构与extract_by_gene_pairs 相同，即[(antecedent, consequent), ...]，
+    # 不在该细胞类型中的基因对会被跳过，返回的结果为边列表的样式
+    def score_gene_pairs(self, adata_subs, gene_pairs):
+        results = {}
+        for cell_type, adata in adata_subs.items():
+            data, genes_info, cells_info = TransformDataReal(adata, backend=Config.ar_backend).run()
+            ar_obj = AssociationRule(data, genes_info, cells_info, backend=Config.ar_backend)
+            gene_index = {gene: index for index, gene in enumerate(genes_info)}
+            pairs = [(a, b) for a, b in gene_pairs if a in gene_index and b in gene_index]
+            metrics = ar_obj.all_metrics_batch([(gene_index[a], gene_index[b]) for a, b in pairs],
+                                               max_bytes=Config.ar_max_bytes)
+            results[cell_type] = pd.DataFrame({
+                "antecedent": [a for a, _ in pairs],
+                "consequent": [b for _, b in pairs],
+                "support": metrics["support_ij"],
+                "confidence": metrics["confidence"],
+                "lift": metrics["lift_ij"],
+                "leverage": metrics["leverage_ij"],
+                "conviction": metrics["conviction_ij"]
+            })
+        return results
+
     def save_result(self, results):
         save_obj = SaveArMetrics(results, self.ar_result_path)
         save_obj.write_result()
@@ -1,8 +1,12 @@
 import scanpy as sc
 from utils.data_process.read_cell_type import read_cell_type
+from utils.data_process.matrix_cache import MatrixCache
 import pandas as pd
+import hashlib
+import json
 import os
 from config import Config
+from utils.data_process.matrix_cache import fingerprint_10x
 
 class DiffereceGene:
     def __init__(self,
@@ -13,10 +17,24 @@ class DiffereceGene:
         self.deg_dict = {}
         self.deg_df_dict = {}
 
-    def load_data(self):
+    # 与LoadMatrixDataReal.load_data 共用解析后的矩阵缓存，只在缓存不存在时解析matrix.mtx
+    def load_data(self, use_cache=None):
+        if use_cache is None:
+            use_cache = Config.matrix_cache
+        if use_cache:
+            return MatrixCache(self.data_path).read_10x()
         adata = sc.read_10x_mtx(self.data_path, var_names='gene_symbols', cache=False)
         return adata
 
+    # 差异基因结果的指纹：10x 数据、细胞类型注释文件以及Config.deg_threshold_dict，任何一个改变时指纹都会改变
+    def fingerprint(self):
+        digest = hashlib.sha1(fingerprint_10x(self.data_path, hash_content=Config.matrix_cache_hash_content).encode())
+        cell_type_fn = os.path.join(self.data_path, self.cell_type_fn)
+        stat = os.stat(cell_type_fn)
+        digest.update(f"{cell_type_fn}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        digest.update(json.dumps(Config.deg_threshold_dict, sort_keys=True).encode())
+        return digest.hexdigest()[:16]
+
     def assign_cell_type(self, adata):
         cell_type_fn = os.path.join(self.data_path, self.cell_type_fn)
         cell_types = read_cell_type(cell_type_fn)
@@ -57,10 +75,14 @@ class DiffereceGene:
         sc.tl.filter_rank_genes_groups(adata, groupby="cell_type", key_added="rank_genes_groups_filtered")
         return adata
 
-    def save_deg_df_dict(self, column_names=None):
+    # overwrite 为False 时只写入不存在的文件（例如从缓存中读取差异基因后，结果文件夹被清空的情况）
+    def save_deg_df_dict(self, column_names=None, overwrite=True):
         deg_dir = Config.deg_fp
+        os.makedirs(deg_dir, exist_ok=True)
         for cell_type, deg_df in self.deg_df_dict.items():
             deg_fn = os.path.join(deg_dir, f"{cell_type}_deg.tsv")
+            if not overwrite and os.path.exists(deg_fn):
+                continue
             if column_names is not None:
                 deg_df = deg_df[column_names]
             deg_df.to_csv(deg_fn, sep='\t', index=False)
@@ -0,0 +1,73 @@
+'''
+按细胞类型并行计算关联规则。每个细胞类型的计算是独立的，这里使用进程池同时计算多个细胞类型，
+每个进程中BLAS（以及TensorFlow）的线程数被限制为threads_per_worker，避免 进程数 × 线程数 远超过cpu的核数。
+进程以spawn 方式启动，子进程会重新导入主模块（例如work_flow.py）以及其导入的numpy，因此init_worker 设置的环境变量
+对已经加载的BLAS 不一定生效，线程数由threadpoolctl 的threadpool_limits 限制，环境变量只作用于之后才加载的库（例如TensorFlow）。
+子进程中的Config 是重新导入的，主进程在运行时对Config 的修改不会被继承，因此build_ar_engine 用到的设置由run_ar_task 显式传入。
+'''
+import os
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+
+_thread_env_names = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+                     "NUMEXPR_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS")
+
+
+def init_worker(threads_per_worker):
+    for name in _thread_env_names:
+        os.environ[name] = str(threads_per_worker)
+    # 对已经加载的BLAS 同样生效
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(threads_per_worker)
+
+
+# build_ar_engine 读取的Config 设置，在主进程中取值后传给子进程
+_config_names = ("ar_max_bytes", "ar_backend", "ar_symmetric", "ar_cache_max_bytes",
+                 "minhash_n_hashes", "minhash_jaccard_threshold")
+
+
+def config_settings():
+    from config import Config
+    return {name: getattr(Config, name) for name in _config_names}
+
+
+# 在子进程中计算一个细胞类型，pipe 为CellTypePipe 对象，settings 为主进程中config_settings 的结果
+def run_ar_task(pipe, cell_type, adata, engine, max_bytes, settings):
+    from config import Config
+    for name, value in settings.items():
+        setattr(Config, name, value)
+    mar_obj = pipe.build_ar_engine(adata, engine=engine, max_bytes=max_bytes)
+    metrics = mar_obj.all_metrics_to_dataframe
+    mar_obj.release()
+    return cell_type, metrics
+
+
+# 估计一个细胞类型的计算量：共现矩阵的计算量为 细胞数 × 基因数^2
+def task_cost(adata):
+    n_cells, n_genes = adata.shape
+    return n_cells * n_genes * n_genes
+
+
+# 使用n_workers 个进程计算所有细胞类型，计算量最大的细胞类型最先提交，以减少最后只剩一个大任务在运行的时间。
+# 返回的字典与adata_subs 的顺序一致
+def run_ar_parallel(pipe, adata_subs, engine, max_bytes=None, n_workers=None, threads_per_worker=None):
+    cpu_count = os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = min(len(adata_subs), cpu_count)
+    n_workers = max(1, n_workers)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, cpu_count // n_workers)
+    order = sorted(adata_subs, key=lambda cell_type: task_cost(adata_subs[cell_type]), reverse=True)
+    settings = config_settings()
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                             initializer=init_worker, initargs=(threads_per_worker,)) as executor:
+        futures = [executor.submit(run_ar_task, pipe, cell_type, adata_subs[cell_type], engine, max_bytes,
+                                   settings)
+                   for cell_type in order]
+        for future in futures:
+            cell_type, metrics = future.result()
+            results[cell_type] = metrics
+    return {cell_type: results[cell_type] for cell_type in adata_subs}
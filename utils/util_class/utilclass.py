@@ -1,4 +1,6 @@
 # 在计算中存在大量的计算量，但是不一定每次都会用到，这时候就可以使用装饰器来实现懒加载
+from collections import OrderedDict
+
 
 class lazyproperty:
     def __init__(self, func):
@@ -10,4 +12,123 @@ class lazyproperty:
         else:
             value = self.func(instance)
             setattr(instance, self.func.__name__, value)
-            return value
\ No newline at end of file
+            return value
+
+
+# 估计一个缓存值占用的内存（字节），支持numpy 数组、scipy 稀疏矩阵、TensorFlow 张量、pandas 对象以及由它们组成的字典、列表
+def estimate_nbytes(value):
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(item) for item in value)
+    if hasattr(value, "memory_usage"):
+        usage = value.memory_usage(index=True)
+        return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if hasattr(value, "indptr"):
+        return int(value.data.nbytes + value.indices.nbytes + value.indptr.nbytes)
+    if hasattr(value, "shape") and hasattr(value, "dtype") and hasattr(value.dtype, "size"):
+        return int(value.shape.num_elements() * value.dtype.size)
+    return 0
+
+
+class MemoryCache:
+    '''
+    带内存上限的LRU缓存，由cachedproperty 使用，每个对象一个。
+    max_bytes 为缓存的内存上限，None 表示不限制；超过上限时按最久未使用的顺序删除可以删除（evictable）的值，
+    被删除的值在下一次访问时重新计算。刚写入的值不会被立即删除。
+    '''
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.values = OrderedDict()
+        self.sizes = {}
+        self.evictable = {}
+
+    @property
+    def nbytes(self):
+        return sum(self.sizes.values())
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def get(self, name):
+        self.values.move_to_end(name)
+        return self.values[name]
+
+    def put(self, name, value, evictable=True):
+        self.values[name] = value
+        self.values.move_to_end(name)
+        self.sizes[name] = estimate_nbytes(value)
+        self.evictable[name] = evictable
+        self.evict(keep=name)
+
+    def evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+        for name in list(self.values):
+            if self.nbytes <= self.max_bytes:
+                break
+            if name != keep and self.evictable[name]:
+                self.pop(name)
+
+    def pop(self, name):
+        self.sizes.pop(name, None)
+        self.evictable.pop(name, None)
+        return self.values.pop(name, None)
+
+    # 删除names 中的值，names 为空时删除所有值，返回释放的字节数
+    def release(self, *names):
+        names = names if names else list(self.values)
+        released = 0
+        for name in names:
+            if name in self.values:
+                released += self.sizes[name]
+                self.pop(name)
+        return released
+
+
+class cachedproperty:
+    '''
+    与lazyproperty 一样在第一次访问时计算，但值保存在对象的MemoryCache 中而不是对象的属性上，
+    缓存的内存上限由对象的 cache_max_bytes 属性给出（None 表示不限制）。
+    evictable 为False 的值（例如共现次数）不会因为超过上限而被删除，只能通过release_cache 释放；
+    其余由它们计算得到的指标在超过上限时按LRU 删除，再次访问时重新计算。
+    可以直接作为装饰器使用，也可以写成 @cachedproperty(evictable=False)
+    '''
+
+    def __init__(self, func=None, evictable=True):
+        self.func = func
+        self.evictable = evictable
+
+    def __call__(self, func):
+        self.func = func
+        return self
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, cls):
+        if instance is None:
+            return self
+        cache = memory_cache(instance)
+        cache.max_bytes = getattr(instance, "cache_max_bytes", None)
+        if self.name in cache:
+            return cache.get(self.name)
+        value = self.func(instance)
+        cache.put(self.name, value, evictable=self.evictable)
+        return value
+
+
+def memory_cache(instance):
+    cache = instance.__dict__.get("_memory_cache")
+    if cache is None:
+        cache = MemoryCache(getattr(instance, "cache_max_bytes", None))
+        instance.__dict__["_memory_cache"] = cache
+    return cache
+
+
+# 释放对象中由cachedproperty 缓存的值，names 为空时全部释放，返回释放的字节数
+def release_cache(instance, *names):
+    return memory_cache(instance).release(*names)